@@ -1,42 +1,203 @@
+import cmath
+import os
+from typing import Optional
+
 import librosa
+import numba
 import numpy as np
+import scipy.fft
 
+from brownify import actions_gpu
 from brownify.models import Track
 
-
-class Brownifier:
-    @staticmethod
-    def _is_stereo(track: Track) -> bool:
-        return track.num_channels == 2
-
-    @staticmethod
-    def _change_pitch_stereo(
-        track: Track, n_steps: int, bins_per_octave: int
-    ) -> Track:
-        track.audio[:, 0] = librosa.effects.pitch_shift(
-            track.audio[:, 0],
-            track.sample_rate,
-            n_steps=n_steps,
-            bins_per_octave=bins_per_octave,
+try:
+    from python_stretch.Signalsmith import Stretch as _Stretch
+except ImportError:  # pragma: no cover
+    _Stretch = None
+
+_N_FFT = 2048
+_HOP_LENGTH = _N_FFT // 4
+# Tracks which are shifted one at a time can spread each FFT over every CPU.
+# Callers shifting several tracks at once pass a smaller share instead.
+_FFT_WORKERS = os.cpu_count() or 1
+
+# Fast pitch shifts are analysed at this rate. Coarse pitch changes are
+# carried by the lower part of the spectrum, so little is lost by dropping
+# the top octave of treble before the phase vocoder.
+_FAST_SAMPLE_RATE = 22050
+
+# Every pitch shift uses the same analysis window, so build it once and share
+# it between threads rather than having librosa rebuild it on each transform
+_WINDOW = librosa.filters.get_window("hann", _N_FFT, fftbins=True)
+_WINDOW.setflags(write=False)
+
+# librosa uses numpy's single-threaded FFT by default, while scipy's FFT can
+# spread the frames of a spectrogram across several workers
+librosa.set_fftlib(scipy.fft)
+
+
+@numba.njit(cache=True, nogil=True)
+def _phase_vocoder(stft: np.ndarray, time_steps: np.ndarray) -> np.ndarray:
+    # Same algorithm as librosa.phase_vocoder, but compiled and run over a
+    # (channels, frequencies, frames) spectrogram in a single pass
+    n_channels, n_bins, n_frames = stft.shape
+    stretched = np.zeros(
+        (n_channels, n_bins, len(time_steps)), dtype=stft.dtype
+    )
+    for c in range(n_channels):
+        for f in range(n_bins):
+            phase_acc = cmath.phase(stft[c, f, 0])
+            for t in range(len(time_steps)):
+                step = time_steps[t]
+                frame = int(step)
+                alpha = step - frame
+                # Frames past the end of the spectrogram are treated as zero
+                left = stft[c, f, frame] if frame < n_frames else 0j
+                right = stft[c, f, frame + 1] if frame + 1 < n_frames else 0j
+                mag = (1.0 - alpha) * abs(left) + alpha * abs(right)
+                stretched[c, f, t] = cmath.rect(mag, phase_acc)
+
+                # librosa subtracts the expected phase advance, wraps the
+                # difference, and adds the advance back. That only changes
+                # the phase by whole turns, which rect() ignores.
+                phase_acc += cmath.phase(right) - cmath.phase(left)
+    return stretched
+
+
+@numba.njit(cache=True, nogil=True)
+def _reverse_inplace(audio: np.ndarray, start: int, stop: int) -> None:
+    # Reverse the order of the samples in [start, stop) of a (samples,
+    # channels) array
+    n_channels = audio.shape[1]
+    i = start
+    j = stop - 1
+    while i < j:
+        for c in range(n_channels):
+            audio[i, c], audio[j, c] = audio[j, c], audio[i, c]
+        i += 1
+        j -= 1
+
+
+@numba.njit(cache=True, nogil=True)
+def _roll_inplace(audio: np.ndarray, shift: int) -> None:
+    # Equivalent to np.roll over the first axis of a (samples, channels)
+    # array, done with three reversals so that no scratch buffer is needed
+    n_samples = audio.shape[0]
+    if n_samples == 0:
+        return
+    shift %= n_samples
+    _reverse_inplace(audio, 0, n_samples)
+    _reverse_inplace(audio, 0, shift)
+    _reverse_inplace(audio, shift, n_samples)
+
+
+def _pitch_shift_batch(
+    audio2d: np.ndarray,
+    sr: int,
+    n_steps: float,
+    bins_per_octave: int,
+    work_sr: Optional[int] = None,
+    fft_workers: Optional[int] = None,
+) -> np.ndarray:
+    # Pitch shift every channel of a (channels, samples) array at once, so
+    # that all channels share a single STFT, phase vocoder, and resample
+    rate = 2.0 ** (-float(n_steps) / bins_per_octave)
+    n_samples = audio2d.shape[-1]
+
+    if work_sr is not None and work_sr < sr:
+        # Analyse a downsampled copy. The resample which finishes the pitch
+        # shift then brings the audio straight back up to the original rate.
+        audio2d = librosa.resample(
+            audio2d, orig_sr=sr, target_sr=work_sr, res_type="kaiser_fast"
         )
-        track.audio[:, 1] = librosa.effects.pitch_shift(
-            track.audio[:, 1],
-            track.sample_rate,
-            n_steps=n_steps,
-            bins_per_octave=bins_per_octave,
+    else:
+        work_sr = sr
+    n_work_samples = audio2d.shape[-1]
+
+    if fft_workers is None:
+        fft_workers = _FFT_WORKERS
+    with scipy.fft.set_workers(fft_workers):
+        stft = librosa.stft(
+            audio2d, n_fft=_N_FFT, hop_length=_HOP_LENGTH, window=_WINDOW
         )
-        return track
+        time_steps = np.arange(0, stft.shape[-1], rate, dtype=np.float64)
+        stretched = _phase_vocoder(stft, time_steps)
+        audio_stretched = librosa.istft(
+            stretched,
+            hop_length=_HOP_LENGTH,
+            window=_WINDOW,
+            dtype=audio2d.dtype,
+            length=int(round(n_work_samples / rate)),
+        )
+    audio_shifted = librosa.resample(
+        audio_stretched,
+        orig_sr=float(work_sr) / rate,
+        target_sr=sr,
+        res_type="kaiser_fast",
+    )
+    return librosa.util.fix_length(audio_shifted, size=n_samples)
+
+
+def _pitch_shift_stretch(
+    audio2d: np.ndarray, sr: int, n_steps: float, bins_per_octave: int
+) -> np.ndarray:
+    # Pitch shift a (channels, samples) array with the Signalsmith Stretch
+    # library, which compensates for its own latency so the output lines up
+    # with the input. Its bindings only accept writable contiguous buffers,
+    # so shared read-only audio is copied first.
+    stretch = _Stretch()
+    stretch.preset(audio2d.shape[0], float(sr))
+    stretch.setTransposeSemitones(12.0 * n_steps / bins_per_octave)
+    return stretch.process(
+        np.require(audio2d, dtype=np.float32, requirements=["C", "W"])
+    )
+
+
+def _pitch_shift(
+    audio2d: np.ndarray,
+    sr: int,
+    n_steps: float,
+    bins_per_octave: int,
+    fast: bool = False,
+    fft_workers: Optional[int] = None,
+) -> np.ndarray:
+    # Prefer a GPU when one can be used, and then Signalsmith Stretch when it
+    # is installed, since both are faster than the phase vocoder here. They
+    # are quick enough at the full sample rate that fast mode only applies
+    # to the vocoder.
+    if actions_gpu.is_available():
+        return actions_gpu.pitch_shift(
+            audio2d, sr, n_steps, bins_per_octave, _N_FFT, _HOP_LENGTH
+        )
+    if _Stretch is not None:
+        return _pitch_shift_stretch(audio2d, sr, n_steps, bins_per_octave)
+    work_sr = _FAST_SAMPLE_RATE if fast else None
+    return _pitch_shift_batch(
+        audio2d, sr, n_steps, bins_per_octave, work_sr, fft_workers
+    )
+
 
+class Brownifier:
     @staticmethod
-    def _change_pitch_mono(
-        track: Track, n_steps: int, bins_per_octave: int
+    def _change_pitch(
+        track: Track,
+        n_steps: float,
+        bins_per_octave: int,
+        fast: bool,
+        fft_workers: Optional[int],
     ) -> Track:
-        track.audio = librosa.effects.pitch_shift(
-            track.audio,
+        # The pitch is shifted over (channels, samples). Transposing a 1-D
+        # mono track is a no-op, so it becomes a single channel of that.
+        audio = track.audio
+        shifted = _pitch_shift(
+            np.atleast_2d(audio.T),
             track.sample_rate,
-            n_steps=n_steps,
-            bins_per_octave=bins_per_octave,
+            n_steps,
+            bins_per_octave,
+            fast,
+            fft_workers,
         )
+        track.audio = shifted.T if audio.ndim == 2 else shifted[0]
         return track
 
     @staticmethod
@@ -45,32 +206,96 @@ class Brownifier:
     ) -> Track:
         """Change the pitch of the track without changing the track speed
 
+        The change is recorded on the track and only applied to its audio by
+        materialize, so that a chain of changes costs a single pitch shift.
+
         Args:
             track: The track to modify
             n_steps: Number of steps to modify by (positive or negative)
             bins_per_octave: Number of steps in an octave. Defaults to 12.
 
         Returns:
-            The track with the pitch changed
+            The track, with the pitch change pending
         """
-        if Brownifier._is_stereo(track):
-            return Brownifier._change_pitch_stereo(
-                track, n_steps, bins_per_octave
-            )
-        else:
-            return Brownifier._change_pitch_mono(
-                track, n_steps, bins_per_octave
+        track.pending_semitones += 12.0 * n_steps / bins_per_octave
+        return track
+
+    @staticmethod
+    def materialize(
+        track: Track, fast: bool = False, fft_workers: Optional[int] = None
+    ) -> Track:
+        """Apply any pending pitch and time changes to the audio of a track
+
+        Args:
+            track: The track to modify
+            fast: Shift the pitch at a reduced sample rate, which is quicker
+                but loses some treble detail. Defaults to False.
+            fft_workers: Number of threads each FFT of the pitch shift may
+                use. Defaults to one per CPU, which suits a track that is
+                materialized on its own.
+
+        Returns:
+            The track with its pending changes applied
+        """
+        if track.pending_samples_shift != 0:
+            audio = track.writable_audio()
+            if audio.ndim == 1:
+                audio = audio[:, np.newaxis]
+            _roll_inplace(audio, track.pending_samples_shift)
+            track.pending_samples_shift = 0
+
+        # Changes which cancel out are skipped, since a round trip through
+        # the STFT would only add rounding error
+        if track.pending_semitones != 0:
+            Brownifier._change_pitch(
+                track, track.pending_semitones, 12, fast, fft_workers
             )
+            track.pending_semitones = 0.0
+
+        return track
+
+    @staticmethod
+    def has_fast_pitch() -> bool:
+        """Check whether materialize can shift the pitch in fast mode
+
+        Fast mode only applies to the phase vocoder, which is not used when
+        pitch shifting can run on a GPU or through Signalsmith Stretch.
+
+        Returns:
+            True if the fast option of materialize has any effect
+        """
+        return not actions_gpu.is_available() and _Stretch is None
+
+    @staticmethod
+    def warmup(sample_rate: int) -> None:
+        """Compile the pitch and time shifting kernels ahead of their first use
+
+        Shift a second of silent stereo audio, so that the compiled code is
+        built or loaded from the on-disk cache before any track needs it.
+
+        Args:
+            sample_rate: Sample rate of the tracks which will be processed
+        """
+        silence = Track(
+            audio=np.zeros((sample_rate, 2), dtype=np.float32),
+            num_channels=2,
+            sample_rate=sample_rate,
+            save=False,
+        )
+        Brownifier.materialize(Brownifier.early(Brownifier.flat(silence)))
 
     @staticmethod
     def flat(track: Track) -> Track:
         """Make the track flat by one semitone
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now flat
+            The track, which will be flat once materialized
         """
         return Brownifier.change_pitch(track, n_steps=-1)
 
@@ -78,11 +303,14 @@ class Brownifier:
     def sharp(track: Track) -> Track:
         """Make the track sharp by one semitone
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now sharp
+            The track, which will be sharp once materialized
         """
         return Brownifier.change_pitch(track, n_steps=1)
 
@@ -90,11 +318,14 @@ class Brownifier:
     def half_flat(track: Track) -> Track:
         """Make the track flat by one quarter tone
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now half-flat
+            The track, which will be half-flat once materialized
         """
         return Brownifier.change_pitch(track, n_steps=-1, bins_per_octave=24)
 
@@ -102,11 +333,14 @@ class Brownifier:
     def half_sharp(track: Track) -> Track:
         """Make the track sharp by one quarter tone
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now half-sharp
+            The track, which will be half-sharp once materialized
         """
         return Brownifier.change_pitch(track, n_steps=1, bins_per_octave=24)
 
@@ -114,11 +348,14 @@ class Brownifier:
     def octave_up(track: Track) -> Track:
         """Move the track up by a full octave
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now an octave higher
+            The track, which will be an octave higher once materialized
         """
         return Brownifier.change_pitch(track, n_steps=12)
 
@@ -126,11 +363,14 @@ class Brownifier:
     def octave_down(track: Track) -> Track:
         """Move the track down by a full octave
 
+        Like change_pitch, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now an octave lower
+            The track, which will be an octave lower once materialized
         """
         return Brownifier.change_pitch(track, n_steps=-12)
 
@@ -140,30 +380,34 @@ class Brownifier:
 
         The track is shifted forward or backward in time by rolling the
         values and wrapping where the track ends back to the beginning
-        or vice-versa
+        or vice-versa. Like change_pitch, the shift is only applied to the
+        audio by materialize.
 
         Args:
             track: The track to modify
             seconds_shift: The number of seconds to shift by
 
         Returns:
-            The track which has been shifted in time
+            The track, with the time shift pending
         """
         seconds_per_sample = 1 / track.sample_rate
         samples_shift = round(seconds_shift / seconds_per_sample)
 
-        track.audio = np.roll(track.audio, samples_shift)
+        track.pending_samples_shift += samples_shift
         return track
 
     @staticmethod
     def early(track: Track) -> Track:
         """Shift the track forward in time by about a 35 milliseconds
 
+        Like time_shift, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now early
+            The track, which will be early once materialized
         """
         return Brownifier.time_shift(track, -0.035)
 
@@ -171,10 +415,13 @@ class Brownifier:
     def late(track: Track) -> Track:
         """Shift a track backward in time by about a 35 milliseconds
 
+        Like time_shift, the change is only recorded on the track, and
+        materialize must be called before its audio reflects it.
+
         Args:
             track: The track to modify
 
         Returns:
-            The track which is now late
+            The track, which will be late once materialized
         """
         return Brownifier.time_shift(track, 0.035)
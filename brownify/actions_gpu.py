@@ -0,0 +1,62 @@
+from fractions import Fraction
+
+import numpy as np
+
+try:
+    import torch
+    import torchaudio
+except ImportError:  # pragma: no cover
+    torch = None
+    torchaudio = None
+
+# Pitch changes are expressed to torchaudio as a whole number of steps, so
+# fractional changes are rounded to the nearest cent
+_CENTS_PER_OCTAVE = 1200
+
+
+def is_available() -> bool:
+    """Check whether pitch shifting can be run on a GPU
+
+    Returns:
+        True if torchaudio is installed and a CUDA device can be used
+    """
+    return torch is not None and torch.cuda.is_available()
+
+
+def pitch_shift(
+    audio2d: np.ndarray,
+    sr: int,
+    n_steps: float,
+    bins_per_octave: int,
+    n_fft: int,
+    hop_length: int,
+) -> np.ndarray:
+    """Change the pitch of audio on a CUDA device
+
+    Args:
+        audio2d: Audio to modify, with shape (channels, samples)
+        sr: Sample rate of the audio
+        n_steps: Number of steps to modify by (positive or negative)
+        bins_per_octave: Number of steps in an octave
+        n_fft: Length of the STFT window
+        hop_length: Number of samples between STFT frames
+
+    Returns:
+        The pitch shifted audio, with the same shape as the input
+    """
+    octaves = Fraction(n_steps / bins_per_octave).limit_denominator(
+        _CENTS_PER_OCTAVE
+    )
+    waveform = torch.from_numpy(
+        np.ascontiguousarray(audio2d, dtype=np.float32)
+    ).cuda()
+    with torch.no_grad():
+        shifted = torchaudio.functional.pitch_shift(
+            waveform,
+            sr,
+            octaves.numerator,
+            bins_per_octave=octaves.denominator,
+            n_fft=n_fft,
+            hop_length=hop_length,
+        )
+    return shifted.cpu().numpy()
@@ -1,20 +1,39 @@
+from __future__ import annotations
+
 import argparse
 import logging
 import os
-import shutil
-import uuid
-from typing import Optional
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Optional, Set
 
-from brownify.downloaders import YoutubeDownloader
 from brownify.errors import BrownifyError, InvalidInputError
-from brownify.parsers import ActionParser
-from brownify.runners import PipelineProcessor
-from brownify.splitters import AudioSplitterFactory, AudioSplitterType
+
+# The audio modules pull in librosa, numba, Spleeter, and TensorFlow, which
+# take seconds to import. They are only imported once the arguments have
+# been parsed, so that --help and usage errors return straight away.
+if TYPE_CHECKING:  # pragma: no cover
+    import numpy as np
+
+    from brownify.models import Pipeline
+    from brownify.splitters import AudioSplitter, AudioSplitterType
 
 _LOG_LEVELS = {"debug", "info", "warning", "error", "critical"}
 _DEFAULT_LOG_LEVEL = "warning"
 
 
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"must be a positive integer, but got {value}"
+        )
+    return number
+
+
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Make your music brown")
 
@@ -37,7 +56,27 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--preserve",
         action="store_true",
-        help="Allow for intermediate files to be preserved for debugging",
+        help="Save the separated sources under a directory named after the "
+        "session for debugging",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        help="Number of pipelines to process in parallel (defaults to the "
+        "number of CPUs)",
+    )
+    parser.add_argument(
+        "--assume-mono-stems",
+        action="store_true",
+        help="Process separated sources whose channels are nearly identical "
+        "as mono to save time (may lose stereo detail)",
+    )
+    parser.add_argument(
+        "--fast-pitch",
+        action="store_true",
+        help="Change pitch at a reduced sample rate to save time (loses some "
+        "treble detail). Has no effect when the GPU or Signalsmith Stretch "
+        "backend is installed",
     )
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--recipe", help="Sequence to apply to audio streams")
@@ -58,34 +97,57 @@ def _get_program(recipe, recipe_file) -> str:
         return recipe
 
     if recipe_file:
-        with open(recipe_file, "r") as f:
-            # Read in program and ignore newlines
-            program = f.read().replace("\n", "")
-            return program
+        with open(recipe_file, "rb") as f:
+            # Read in program and ignore line endings, dropping them from the
+            # raw bytes in a single pass before decoding
+            program = f.read().translate(None, b"\r\n")
+        try:
+            return program.decode("utf-8")
+        except UnicodeDecodeError:
+            raise InvalidInputError(
+                f"Recipe file {recipe_file} is not valid UTF-8 text"
+            )
 
     raise InvalidInputError(
         "Either a recipe or a recipe file must be provided"
     )
 
 
-def _cleanup(downloaded_file, session_id):
-    try:
-        # Clean the intermediate downloaded file if it exists
-        os.remove(downloaded_file)
-    except OSError as ose:
-        logging.warning(f"Could not remove downloaded file {downloaded_file}")
-        logging.debug(ose, exc_info=True)
+def _get_stems(pipelines: List[Pipeline]) -> Set[str]:
+    # Any source which is read before a pipeline has written it must be one
+    # of the separated stems
+    stems = set()
+    written = set()
+    for pipeline in pipelines:
+        if pipeline.source not in written:
+            stems.add(pipeline.source)
+        written.add(pipeline.sink)
+    return stems
+
+
+def _get_splitter(splitter_type: AudioSplitterType) -> AudioSplitter:
+    from brownify.splitters import AudioSplitterFactory
+
+    splitter = AudioSplitterFactory.get_audio_splitter(splitter_type)
+    splitter.warmup()
+    return splitter
+
+
+def _preserve_sources(
+    sources: Dict[str, np.ndarray], session_id: str, sample_rate: int
+) -> None:
+    import soundfile as sf
 
     try:
-        # Spleeter stores its files in a directory named after the original
-        # file's base name
-        shutil.rmtree(str(session_id))
-    except OSError as ose:
+        os.makedirs(session_id, exist_ok=True)
+        for channel, audio in sources.items():
+            sf.write(f"./{session_id}/{channel}.wav", audio, sample_rate)
+    except (OSError, RuntimeError) as e:
         logging.warning(
-            "Could not remove intermediate processed files under directory "
-            f"{session_id}/"
+            "Could not preserve separated sources under directory %s/",
+            session_id,
         )
-        logging.debug(ose, exc_info=True)
+        logging.debug(e, exc_info=True)
 
 
 def main() -> int:
@@ -98,6 +160,9 @@ def main() -> int:
     preserve = args.preserve
     recipe = args.recipe
     recipe_file = args.recipe_file
+    jobs: Optional[int] = args.jobs
+    assume_mono_stems = args.assume_mono_stems
+    fast_pitch = args.fast_pitch
 
     # Put logging setup in its own block so if it fails, we can fail loudly
     try:
@@ -107,46 +172,89 @@ def main() -> int:
         logging.error(iie)
         return 1
 
+    # Let TensorFlow grow its GPU memory on demand rather than reserving all
+    # of it up front, so Spleeter can share any visible GPU during the split
+    os.environ.setdefault("TF_FORCE_GPU_ALLOW_GROWTH", "true")
+
     # Create a random ID for tracking this session
-    session_id = str(uuid.uuid4())
+    session_id = secrets.token_hex(8)
 
-    # Declare input filename to be set by either the local file
-    # or by downloading an audio file from youtube
-    input_file: Optional[str] = None
+    from brownify.actions import Brownifier
+    from brownify.downloaders import YoutubeDownloader
+    from brownify.parsers import get_parser
+    from brownify.runners import PipelineProcessor
+    from brownify.splitters import AudioSplitter, AudioSplitterFactory
 
     try:
         # Get the program from user input
         program = _get_program(recipe, recipe_file)
 
         # Based on the program, instantiate a processing pipeline
-        ap = ActionParser()
+        ap = get_parser()
         pipelines = ap.get_pipelines(program)
 
-        # Grab an audio file based on the provided inputs
-        if youtube_url is not None:
-            # Create download filename based on session ID
-            download_file = f"{session_id}.mp4"
-            YoutubeDownloader.get_audio(youtube_url, download_file)
-            input_file = download_file
-        elif local_file is not None:
-            _, local_file_ext = os.path.splitext(local_file)
-            input_file = f"{session_id}{local_file_ext}"
-            # Create a symlink to the local file for this session
-            os.symlink(local_file, input_file)
-        else:
-            raise InvalidInputError(
-                "For audio input, a path to a local file or a youtube URL "
-                "must be provided"
+        if fast_pitch and not Brownifier.has_fast_pitch():
+            logging.warning(
+                "Ignoring --fast-pitch, since pitch is shifted by a faster "
+                "backend which always runs at the full sample rate"
             )
 
-        # Split the input audio into different tracks
-        splitter = AudioSplitterFactory.get_audio_splitter(
-            AudioSplitterType.FIVE_STEM
+        # Fetching the files of the separation model and compiling the action
+        # kernels do not depend on the input audio, so do them in the
+        # background while the audio is being fetched or decoded. Neither
+        # builds the model graph, which only happens when the audio is split,
+        # so a local file has nothing expensive to wait on here either.
+        splitter_type = AudioSplitterFactory.get_audio_splitter_type(
+            _get_stems(pipelines)
         )
-        splitter.split(input_file)
+        executor = ThreadPoolExecutor(max_workers=2)
+        splitter_future = executor.submit(_get_splitter, splitter_type)
+        warmup_future = executor.submit(
+            Brownifier.warmup, AudioSplitter.SAMPLE_RATE
+        )
+        try:
+            # Grab the input audio based on the provided inputs. It is
+            # decoded straight into memory and never written back to disk.
+            if youtube_url is not None:
+                waveform = YoutubeDownloader.get_waveform(
+                    youtube_url, AudioSplitter.SAMPLE_RATE
+                )
+            elif local_file is not None:
+                waveform = AudioSplitter.load(local_file)
+            else:
+                raise InvalidInputError(
+                    "For audio input, a path to a local file or a youtube "
+                    "URL must be provided"
+                )
+
+            splitter = splitter_future.result()
+            warmup_future.result()
+        except BaseException:
+            # Report bad input straight away rather than waiting for the
+            # background work first. Work which has not started is dropped,
+            # and cancel_futures is not used since it needs Python 3.9. A
+            # model download which is already running is still finished
+            # before the interpreter exits, so its files are never left
+            # half written.
+            splitter_future.cancel()
+            warmup_future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+
+        # Split the input audio into different tracks
+        sources = splitter.split(waveform)
+        if preserve:
+            _preserve_sources(sources, session_id, splitter.SAMPLE_RATE)
 
         # Perform processing pipeline over the audio
-        processor = PipelineProcessor(session_id, splitter)
+        processor = PipelineProcessor(
+            sources,
+            splitter.SAMPLE_RATE,
+            max_workers=jobs,
+            assume_mono_stems=assume_mono_stems,
+            fast_pitch=fast_pitch,
+        )
         processor.process(pipelines, output_file)
 
         return 0
@@ -157,9 +265,3 @@ def main() -> int:
         logging.error(be)
         logging.debug(be, exc_info=True)
         return 1
-
-    finally:
-        # Clean up temporary files unless they have been marked for
-        # preservation
-        if not preserve:
-            _cleanup(input_file, session_id)
@@ -1,6 +1,8 @@
+import ffmpeg
+import numpy as np
 import yt_dlp
 
-from brownify.errors import NoAudioStreamFoundError
+from brownify.errors import DownloadError, NoAudioStreamFoundError
 
 
 class YoutubeDownloader:
@@ -39,3 +41,57 @@ class YoutubeDownloader:
                 raise NoAudioStreamFoundError(
                     f"No audio stream found at {url}"
                 )
+
+    @staticmethod
+    def get_waveform(url: str, sample_rate: int) -> np.ndarray:
+        """Method to fetch audio straight into memory
+
+        The audio stream is decoded as it is fetched, so nothing is written
+        to disk and the audio is only decoded once.
+
+        Args:
+            url: URL for the YouTube video to download audio from
+            sample_rate: Sample rate to decode the audio at
+
+        Raises:
+            NoAudioStreamFoundError: If no audio stream can be found for the
+                provided URL
+            DownloadError: If the audio stream could not be fetched or
+                decoded
+
+        Returns:
+            Stereo float32 waveform with shape (samples, 2)
+        """
+        options = {
+            "format": "bestaudio",
+            "quiet": True,
+        }
+        with yt_dlp.YoutubeDL(options) as downloader:
+            try:
+                info = downloader.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError:
+                raise NoAudioStreamFoundError(
+                    f"No audio stream found at {url}"
+                )
+
+        stream_url = info.get("url")
+        if stream_url is None:
+            raise NoAudioStreamFoundError(f"No audio stream found at {url}")
+
+        # YouTube rejects stream requests which do not carry the same headers
+        # that were used to resolve the stream
+        headers = "".join(
+            f"{key}: {value}\r\n"
+            for key, value in info.get("http_headers", {}).items()
+        )
+
+        try:
+            pcm, _ = (
+                ffmpeg.input(stream_url, headers=headers)
+                .output("pipe:", format="f32le", ac=2, ar=sample_rate)
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+        except ffmpeg.Error:
+            raise DownloadError(f"Unable to decode the audio stream at {url}")
+
+        return np.frombuffer(pcm, dtype=np.float32).reshape(-1, 2)
@@ -37,29 +37,60 @@ class Track:
     Args:
         audio: Array containing the an sequence of audio data; the first
             dimension represents time, and the second dimension (if present)
-            represents channels
+            represents channels. Audio data is always stored as float32.
         num_channels: Number of channels in the audio data
         sample_rate: The rate at which the audio data was sampled
         save: Mark a track to be saved in the final merged file
+        pending_semitones: Pitch change in semitones which has been requested
+            but not yet applied to the audio data
+        pending_samples_shift: Time shift in samples which has been requested
+            but not yet applied to the audio data
     """
 
     audio: np.ndarray
     num_channels: int
     sample_rate: int
     save: bool
+    pending_semitones: float = 0.0
+    pending_samples_shift: int = 0
+
+    def __post_init__(self):
+        # Single precision is plenty for audio, and it halves the memory
+        # traffic of every action compared to float64
+        self.audio = np.asarray(self.audio, dtype=np.float32)
 
     def clone(self) -> Track:
         """Clone a track
 
-        Create a deep copy of a track with the save parameter always
-        initialized to False
+        Create a copy-on-write copy of a track with the save parameter always
+        initialized to False. The clone shares its audio data with the
+        original track through a read-only view, so the data is only copied
+        if the clone is modified in place (see writable_audio). Any pending
+        changes are carried over to the clone.
 
         Returns:
-            A deep copy of the original track
+            A copy of the original track
         """
+        audio = self.audio.view()
+        audio.setflags(write=False)
         return Track(
-            audio=np.copy(self.audio),
+            audio=audio,
             num_channels=self.num_channels,
             sample_rate=self.sample_rate,
             save=False,
+            pending_semitones=self.pending_semitones,
+            pending_samples_shift=self.pending_samples_shift,
         )
+
+    def writable_audio(self) -> np.ndarray:
+        """Get the audio data of the track so that it can be modified in place
+
+        If the audio data is shared with another track, it is copied first
+        so that modifications do not affect the other track.
+
+        Returns:
+            The audio data of the track, which is safe to modify in place
+        """
+        if not self.audio.flags.writeable:
+            self.audio = np.copy(self.audio)
+        return self.audio
@@ -1,4 +1,6 @@
-from typing import List, Union
+import functools
+import re
+from typing import List, Optional, Tuple, Union
 
 import pyparsing as pp
 
@@ -10,6 +12,79 @@ from brownify.errors import (
 )
 from brownify.models import Pipeline
 
+# The recipe grammar has no parse actions with side effects, so memoizing
+# partial matches is safe and avoids re-matching alternatives on backtrack
+pp.ParserElement.enablePackrat(cache_size_limit=None)
+
+# Terminals of the recipe grammar, tried in order after skipping the same
+# whitespace that pyparsing skips between tokens
+_TOKEN = re.compile(
+    r"[ \t\r\n]*(?:(?P<connector>->)|(?P<eol>;)|(?P<save>save\()"
+    r"|(?P<close>\))|(?P<entity>[A-Za-z0-9]+))"
+)
+_WHITESPACE = " \t\r\n"
+
+# States of the recipe scanner
+_EXPECT_FIRST_SOURCE = 0
+_EXPECT_SOURCE = 1
+_EXPECT_CONNECTOR = 2
+_EXPECT_STEP = 3
+_EXPECT_SAVE_NAME = 4
+_EXPECT_SAVE_CLOSE = 5
+_EXPECT_EOL = 6
+
+# Scanner state reached from each state on each kind of token. An entity in a
+# step is taken to be the sink here, unless it turns out to be an action.
+_TRANSITIONS = {
+    (_EXPECT_FIRST_SOURCE, "entity"): _EXPECT_CONNECTOR,
+    (_EXPECT_SOURCE, "entity"): _EXPECT_CONNECTOR,
+    (_EXPECT_CONNECTOR, "connector"): _EXPECT_STEP,
+    (_EXPECT_STEP, "save"): _EXPECT_SAVE_NAME,
+    (_EXPECT_STEP, "entity"): _EXPECT_EOL,
+    (_EXPECT_SAVE_NAME, "entity"): _EXPECT_SAVE_CLOSE,
+    (_EXPECT_SAVE_CLOSE, "close"): _EXPECT_EOL,
+    (_EXPECT_EOL, "eol"): _EXPECT_SOURCE,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_grammar() -> pp.ParserElement:
+    # The grammar holds no per-parser state, so every ActionParser shares the
+    # same one rather than rebuilding it
+    channel = (
+        pp.Keyword("bass")
+        | pp.Keyword("drums")
+        | pp.Keyword("piano")
+        | pp.Keyword("other")
+        | pp.Keyword("vocals")
+    )
+    entity = pp.Word(pp.alphanums)
+    source = channel | entity
+    drop = pp.Keyword("drop")
+    var = entity
+    # Punctuation is suppressed, so a save declaration is left as a
+    # group holding just the name of its sink
+    save = pp.Group(pp.Suppress("save(") + entity + pp.Suppress(")"))
+    sink = drop | save | var
+    action = (
+        pp.Keyword("early")
+        | pp.Keyword("flat")
+        | pp.Keyword("halfflat")
+        | pp.Keyword("halfsharp")
+        | pp.Keyword("late")
+        | pp.Keyword("octavedown")
+        | pp.Keyword("octaveup")
+        | pp.Keyword("sharp")
+    )
+    connector = pp.Suppress("->")
+    expression = pp.Group(
+        source + connector + (action + connector)[0, ...] + sink
+    )
+    eol = pp.Suppress(";")
+    pipelines = pp.delimitedList(expression, delim=eol) + eol[0, 1]
+
+    return pipelines
+
 
 class ActionParser:
     """ActionParser defines and parses the recipe grammar
@@ -21,45 +96,6 @@ class ActionParser:
     """
 
     def __init__(self):
-        self._channel = (
-            pp.Keyword("bass")
-            | pp.Keyword("drums")
-            | pp.Keyword("piano")
-            | pp.Keyword("other")
-            | pp.Keyword("vocals")
-        )
-        self._entity = pp.Word(pp.alphanums)
-        self._source = self._channel | self._entity
-        self._drop = pp.Keyword("drop")
-        self._var = self._entity
-        self._save = pp.Group(
-            pp.Literal("save(") + self._entity + pp.Literal(")")
-        )
-        self._sink = self._drop | self._save | self._var
-        self._action = (
-            pp.Keyword("early")
-            | pp.Keyword("flat")
-            | pp.Keyword("halfflat")
-            | pp.Keyword("halfsharp")
-            | pp.Keyword("late")
-            | pp.Keyword("octavedown")
-            | pp.Keyword("octaveup")
-            | pp.Keyword("sharp")
-        )
-        self._connector = pp.Literal("->")
-        self._expression = pp.Group(
-            self._source
-            + self._connector
-            + (self._action + self._connector)[0, ...]
-            + self._sink
-        )
-        self._eol = pp.Literal(";")
-        self._pipelines = (
-            self._expression
-            + (self._eol + self._expression)[0, ...]
-            + self._eol[0, 1]
-        )
-
         self._fn_map = {
             "early": Brownifier.early,
             "flat": Brownifier.flat,
@@ -70,44 +106,98 @@ class ActionParser:
             "octaveup": Brownifier.octave_up,
             "sharp": Brownifier.sharp,
         }
+        # Tokens have already matched the grammar by the time they are
+        # classified, so plain lookups are enough to tell them apart
+        self._action_set = frozenset(self._fn_map)
 
-    @staticmethod
-    def _matches_parser_element(token: str, pe: pp.ParserElement) -> bool:
-        # FIXME: Is there a better way?
-        try:
-            pe.parseString(token)
-            return True
-        except pp.ParseException:
-            return False
+    @property
+    def _pipelines(self) -> pp.ParserElement:
+        # Valid recipes are handled by the scanner, so the grammar is only
+        # built the first time a recipe needs to be diagnosed
+        return _get_grammar()
 
     def _is_action(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._action)
+        return token in self._action_set
 
-    def _is_connector(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._connector)
+    @staticmethod
+    def _is_entity(token: str) -> bool:
+        # Matches the alphanumeric words accepted by the entity grammar
+        return token.isascii() and token.isalnum()
 
     def _is_source(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._source)
+        return self._is_entity(token)
 
-    def _is_sink(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._sink)
-
-    def _is_save(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._save)
+    @staticmethod
+    def _is_save(item: Union[str, List[str]]) -> bool:
+        return isinstance(item, list)
 
-    def _is_drop(self, token: str) -> bool:
-        return self._matches_parser_element(token, self._drop)
+    @staticmethod
+    def _is_drop(token: str) -> bool:
+        return token == "drop"
 
     @staticmethod
-    def _split_into_expressions(
-        program: pp.ParseResults,
-    ) -> List[List[Union[str, List[str]]]]:
-        pipeline_specs = []
-        for expression in program.asList():
-            if expression != ";":
-                pipeline_specs.append(expression)
+    def _tokenize(program: str) -> Optional[List[Tuple[str, str]]]:
+        tokens = []
+        position = 0
+        end = len(program.rstrip(_WHITESPACE))
+        while position < end:
+            match = _TOKEN.match(program, position)
+            if match is None:
+                return None
+            # Every alternative of the token pattern is a named group
+            kind = match.lastgroup
+            assert kind is not None
+            tokens.append((kind, match.group(kind)))
+            position = match.end()
+        return tokens
+
+    def _scan(
+        self, program: str
+    ) -> Optional[List[List[Union[str, List[str]]]]]:
+        # Walk the recipe with a state machine, producing the same grouped
+        # tokens as the pyparsing grammar. Anything unexpected returns None so
+        # that the grammar can report exactly what is wrong.
+        tokens = self._tokenize(program)
+        if tokens is None:
+            return None
+
+        expressions: List[List[Union[str, List[str]]]] = []
+        state = _EXPECT_FIRST_SOURCE
+        for index, (kind, value) in enumerate(tokens):
+            next_state = _TRANSITIONS.get((state, kind))
+            if next_state is None:
+                return None
 
-        return pipeline_specs
+            if state in (_EXPECT_FIRST_SOURCE, _EXPECT_SOURCE):
+                expressions.append([value])
+            elif state == _EXPECT_STEP and kind == "entity":
+                if (
+                    index + 1 < len(tokens)
+                    and tokens[index + 1][0] == "connector"
+                ):
+                    # Only actions may be followed by another step
+                    if not self._is_action(value):
+                        return None
+                    next_state = _EXPECT_CONNECTOR
+                expressions[-1].append(value)
+            elif state == _EXPECT_SAVE_NAME:
+                expressions[-1].append([value])
+            state = next_state
+
+        if state not in (_EXPECT_EOL, _EXPECT_SOURCE):
+            return None
+
+        return expressions
+
+    def _parse(self, program: str) -> List[List[Union[str, List[str]]]]:
+        try:
+            parsed = self._pipelines.parseString(program, parseAll=True)
+        except pp.ParseException as pe:
+            raise InvalidInputError(
+                f"Invalid recipe: See line {pe.lineno} column {pe.col}\n"
+                f"Details: {pe}"
+            )
+        return parsed.asList()
 
     def _convert_into_pipeline(
         self, expression: List[Union[str, List[str]]]
@@ -130,41 +220,30 @@ class ActionParser:
         for item in expression[1:]:
             # We need to handle both individual tokens and grouped tokens.
             # An example of a grouped token is a save token, which will
-            # take the form ["save(", "NAME", ")"].
-            token = None
-            if isinstance(item, str):
-                token = item
-            elif isinstance(item, list):
-                token = "".join(item)
-            else:
+            # take the form ["NAME"] once its punctuation is suppressed.
+            if self._is_save(item):
+                if len(item) != 1:
+                    raise TokenNotInGrammarError(
+                        f"Token {item} is not a valid save declaration"
+                    )
+
+                sink = item[0]
+                save = True
+            elif not isinstance(item, str):
                 raise UnexpectedTokenTypeError(
-                    f"Encountered unexpected token type: {type(token)}"
+                    f"Encountered unexpected token type: {type(item)}"
                 )
-
-            # Parse the input program to construct pipelines
-            if self._is_action(token):
-                actions.append(self._fn_map[item])
-            elif self._is_sink(token):
-                if self._is_drop(token):
-                    return None
-                elif self._is_save(token):
-                    # Skip over the part of the lit that says "save(" and ")"
-                    # There should only be one element.
-                    sink_name_parts = item[1:-1]
-                    if len(sink_name_parts) != 1:
-                        raise TokenNotInGrammarError(
-                            f"Token {token} is not a valid save declaration"
-                        )
-
-                    sink = sink_name_parts[0]
-                    save = True
-                else:
-                    sink = token
-            elif self._is_connector(token):
-                continue
+            # Parse the input program to construct pipelines. A single probe
+            # of the action map both classifies and resolves an action.
+            elif (action := self._fn_map.get(item)) is not None:
+                actions.append(action)
+            elif self._is_drop(item):
+                return None
+            elif self._is_entity(item):
+                sink = item
             else:
                 raise TokenNotInGrammarError(
-                    f"Token {token} is not part of valid grammar"
+                    f"Token {item} is not part of valid grammar"
                 )
 
         if not isinstance(sink, str):
@@ -186,20 +265,29 @@ class ActionParser:
         Returns:
             Sequence of pipelines to be run
         """
-        try:
-            parsed = self._pipelines.parseString(program, parseAll=True)
-        except pp.ParseException as pe:
-            raise InvalidInputError(
-                f"Invalid recipe: See line {pe.lineno} column {pe.col}\n"
-                f"Details: {pe}"
-            )
-
-        pipeline_exprs = self._split_into_expressions(parsed)
+        expressions = self._scan(program)
+        if expressions is None:
+            # The scanner only accepts valid recipes, so fall back to the full
+            # grammar to explain what is wrong with this one
+            expressions = self._parse(program)
 
         pipelines = []
-        for pipeline_expr in pipeline_exprs:
+        for pipeline_expr in expressions:
             pipeline = self._convert_into_pipeline(pipeline_expr)
             if pipeline:
                 pipelines.append(pipeline)
 
         return pipelines
+
+
+@functools.lru_cache(maxsize=None)
+def get_parser() -> ActionParser:
+    """Get the shared ActionParser
+
+    The parser is only created the first time it is requested, and is reused
+    by every later caller.
+
+    Returns:
+        The ActionParser shared by all callers
+    """
+    return ActionParser()
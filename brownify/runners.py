@@ -1,85 +1,320 @@
-from typing import Dict, List
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-import soundfile as sf
+import numpy as np
 from pydub import AudioSegment
 from pydub.exceptions import PydubException
 from tqdm import tqdm
 
+from brownify.actions import Brownifier
 from brownify.errors import (
     InvalidInputError,
     MergingError,
     NoPipelineSourceError,
 )
 from brownify.models import Pipeline, Track
-from brownify.splitters import AudioSplitter
+
+try:
+    import lameenc as _lameenc
+except ImportError:  # pragma: no cover
+    _lameenc = None
+
+# Stems are compared over short windows spread across the whole track when
+# checking whether their channels carry the same signal. Silent windows say
+# nothing about the stereo image, so they are skipped.
+_MONO_CHECK_SAMPLES = 4096
+_MONO_CHECK_WINDOWS = 32
+_MONO_TOLERANCE = 1e-3
+_SILENCE_LEVEL = 1e-3
+
+# MP3 encoder settings used when lameenc is installed. The bit rate matches
+# the default used by ffmpeg when exporting through pydub.
+_MP3_BIT_RATE = 128
+_MP3_QUALITY = 2
+
+# Identifies the audio produced by applying a sequence of actions to a source
+_PrefixKey = Tuple[str, int, Tuple[Callable, ...]]
+
+# Actions which only move a track in time, and so are cheap to apply on top
+# of audio whose pitch has already been shifted
+_TIME_SHIFTS = frozenset({Brownifier.early, Brownifier.late})
 
 
 class PipelineProcessor:
-    """Class for processing a series of Pipeline objects"""
+    """Class for processing a series of Pipeline objects
+
+    The processor takes ownership of the source audio it is given, which may
+    be modified in place while pipelines are processed.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, np.ndarray],
+        sample_rate: int,
+        max_workers: Optional[int] = None,
+        assume_mono_stems: bool = False,
+        fast_pitch: bool = False,
+    ):
+        if max_workers is not None and max_workers < 1:
+            raise InvalidInputError(
+                f"At least one worker is needed, but got {max_workers}"
+            )
 
-    def __init__(self, target: str, splitter: AudioSplitter):
         self.tracks: Dict[str, Track] = {}
-        self.target = target
-        self._splitter = splitter
-        self._saved_files: List[str] = []
-        for channel in tqdm(
-            splitter.get_channels(), "Loading split sources for processing..."
-        ):
-            filename = f"./{target}/{channel}.wav"
-            self.tracks[channel] = self._load_track(filename)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self._max_workers = max_workers
+        self._fast_pitch = fast_pitch
+        self._saved_tracks: List[Track] = []
+        self._prefixes: Dict[_PrefixKey, Track] = {}
+        for channel, audio in sources.items():
+            if assume_mono_stems and self._is_mono(audio):
+                # Mono tracks are processed once rather than per channel, and
+                # are mixed back into every channel when merging
+                audio = audio.mean(axis=1)
+            self.tracks[channel] = Track(
+                audio=audio,
+                num_channels=1 if audio.ndim == 1 else audio.shape[1],
+                sample_rate=sample_rate,
+                save=False,
+            )
+
+    @staticmethod
+    def _is_mono(audio: np.ndarray) -> bool:
+        if audio.ndim == 1 or audio.shape[1] < 2 or len(audio) == 0:
+            return False
+        last_start = max(len(audio) - _MONO_CHECK_SAMPLES, 0)
+        starts = np.unique(
+            np.linspace(0, last_start, _MONO_CHECK_WINDOWS).astype(int)
+        )
+        heard = False
+        for start in starts:
+            stop = start + _MONO_CHECK_SAMPLES
+            window = audio[start:stop]
+            if np.abs(window).max() < _SILENCE_LEVEL:
+                continue
+            heard = True
+            if not all(
+                np.allclose(window[:, 0], window[:, c], atol=_MONO_TOLERANCE)
+                for c in range(1, window.shape[1])
+            ):
+                return False
+        # A track which is silent everywhere gives no evidence either way,
+        # so it keeps all of its channels
+        return heard
 
     @staticmethod
-    def _load_track(filename: str) -> Track:
-        audio, sample_rate = sf.read(filename)
+    def _get_prefixes(
+        pipelines: List[Pipeline],
+    ) -> Tuple[Dict[int, Tuple[int, _PrefixKey]], Dict[int, _PrefixKey]]:
+        # Actions only record their changes, so the work worth sharing is a
+        # finished pitch shift. Only the complete action list of a pipeline
+        # is applied to its audio, so that is the one prefix it can offer,
+        # and only if it changes the pitch. A later pipeline reuses it only
+        # when the rest of its own actions are time shifts, since shifting
+        # the pitch of audio which was already shifted would differ from the
+        # single fused shift. Each prefix is keyed by its source and by the
+        # index of the pipeline that last wrote that source, so equal keys
+        # always describe equal audio.
+        last_write: Dict[str, int] = {}
+        prefixes: List[List[_PrefixKey]] = []
+        producers: Dict[_PrefixKey, int] = {}
+        for index, pipeline in enumerate(pipelines):
+            version = last_write.get(pipeline.source, -1)
+            keys = [
+                (pipeline.source, version, tuple(pipeline.actions[:n]))
+                for n in range(1, len(pipeline.actions) + 1)
+            ]
+            if any(action not in _TIME_SHIFTS for action in pipeline.actions):
+                producers.setdefault(keys[-1], index)
+            prefixes.append(keys)
+            last_write[pipeline.sink] = index
 
-        is_stereo = True
-        if len(audio.shape) == 1:
-            is_stereo = False
+        reuses: Dict[int, Tuple[int, _PrefixKey]] = {}
+        offers: Dict[int, _PrefixKey] = {}
+        for index, (pipeline, keys) in enumerate(zip(pipelines, prefixes)):
+            for key in reversed(keys):
+                producer = producers.get(key)
+                if producer is None or producer >= index:
+                    continue
+                # The rest of a shorter prefix includes the rest of this one,
+                # so there is no point in looking any further
+                done = len(key[2])
+                if all(
+                    action in _TIME_SHIFTS
+                    for action in pipeline.actions[done:]
+                ):
+                    reuses[index] = (producer, key)
+                    offers[producer] = key
+                break
 
-        num_channels = 2 if is_stereo else 1
+        return reuses, offers
 
-        return Track(
-            audio=audio,
-            num_channels=num_channels,
-            sample_rate=sample_rate,
-            save=False,
-        )
+    @staticmethod
+    def _get_exclusive(pipelines: List[Pipeline]) -> Set[int]:
+        # Find the pipelines which are the only reader of their source and
+        # which replace it with their sink. Nothing else can see the source
+        # track once such a pipeline has started, so it can work on that
+        # track directly rather than on a clone of it.
+        last_write: Dict[str, int] = {}
+        versions: List[Tuple[str, int]] = []
+        for index, pipeline in enumerate(pipelines):
+            versions.append(
+                (pipeline.source, last_write.get(pipeline.source, -1))
+            )
+            last_write[pipeline.sink] = index
+
+        readers = Counter(versions)
+        return {
+            index
+            for index, (pipeline, version) in enumerate(
+                zip(pipelines, versions)
+            )
+            if pipeline.source == pipeline.sink and readers[version] == 1
+        }
 
     @staticmethod
-    def _save_track(filename: str, track: Track) -> None:
-        sf.write(filename, track.audio, track.sample_rate)
+    def _get_stages(
+        pipelines: List[Pipeline],
+        dependencies: Optional[Dict[int, int]] = None,
+    ) -> List[List[int]]:
+        # Group pipelines into stages whose members can run concurrently.
+        # A pipeline must run after the last pipeline writing its source, and
+        # no earlier than any pipeline which reads or writes its sink. Sinks
+        # are only committed once a stage completes, in recipe order, so
+        # pipelines sharing a stage always see the sources from before it.
+        # Pipelines also run after any earlier pipeline they depend on.
+        last_read: Dict[str, int] = {}
+        last_write: Dict[str, int] = {}
+        assigned: List[int] = []
+        stages: List[List[int]] = []
+        for index, pipeline in enumerate(pipelines):
+            stage = max(
+                last_write.get(pipeline.source, -1) + 1,
+                last_read.get(pipeline.sink, 0),
+                last_write.get(pipeline.sink, 0),
+            )
+            if dependencies and index in dependencies:
+                stage = max(stage, assigned[dependencies[index]] + 1)
+            if stage == len(stages):
+                stages.append([])
+            stages[stage].append(index)
+            assigned.append(stage)
 
-    def _process(self, pipelines: List[Pipeline]) -> None:
-        for pipeline in tqdm(pipelines, desc="Brownifying..."):
-            if pipeline.source not in self.tracks:
-                raise NoPipelineSourceError(
-                    f"No track has been loaded with the name {pipeline.source}"
-                    f" yet. Is your recipe correct? Pipeline: {pipeline}"
-                )
-
-            track = self.tracks[pipeline.source].clone()
-
-            for action in pipeline.actions:
-                track = action(track)
-
-            # It is OK to overwrite sources with sinks, so no need to check
-            self.tracks[pipeline.sink] = Track(
-                audio=track.audio,
-                num_channels=track.num_channels,
-                sample_rate=track.sample_rate,
-                save=pipeline.save,
+            last_read[pipeline.source] = max(
+                last_read.get(pipeline.source, 0), stage
             )
+            last_write[pipeline.sink] = stage
+
+        return stages
+
+    def _run_pipeline(
+        self,
+        pipeline: Pipeline,
+        reuse: Optional[_PrefixKey],
+        offer: Optional[_PrefixKey],
+        exclusive: bool,
+        fft_workers: int,
+    ) -> Track:
+        if reuse is None:
+            track = self.tracks[pipeline.source]
+            if not exclusive:
+                track = track.clone()
+            done = 0
+        else:
+            track = self._prefixes[reuse].clone()
+            done = len(reuse[2])
+
+        for action in pipeline.actions[done:]:
+            track = action(track)
+
+        # Actions only record their changes, which are all applied at once
+        track = Brownifier.materialize(track, self._fast_pitch, fft_workers)
+        if offer is not None:
+            # The cached prefix and this pipeline each keep their own clone.
+            # Cloning also leaves the cached audio read-only, so any later
+            # in-place action on the sink copies it first.
+            self._prefixes[offer] = track.clone()
+            track = track.clone()
+
+        return Track(
+            audio=track.audio,
+            num_channels=track.num_channels,
+            sample_rate=track.sample_rate,
+            save=pipeline.save,
+        )
+
+    def _process(self, pipelines: List[Pipeline]) -> None:
+        reuses, offers = self._get_prefixes(pipelines)
+        dependencies = {
+            index: producer for index, (producer, _) in reuses.items()
+        }
+        remaining = Counter(key for _, key in reuses.values())
+        exclusive = self._get_exclusive(pipelines)
+        stages = self._get_stages(pipelines, dependencies)
+
+        # No stage can keep more threads busy than it has pipelines
+        max_workers = min(
+            self._max_workers, max((len(stage) for stage in stages), default=1)
+        )
+        # Pipelines in a stage share the CPUs, so their FFTs split them too
+        # rather than each asking for every CPU
+        fft_workers = max(1, (os.cpu_count() or 1) // max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Progress bars are only drawn when stderr is a terminal, so
+            # batch runs skip their formatting and output entirely
+            with tqdm(
+                total=len(pipelines), desc="Brownifying...", disable=None
+            ) as progress:
+                for stage in stages:
+                    for index in stage:
+                        pipeline = pipelines[index]
+                        if pipeline.source not in self.tracks:
+                            raise NoPipelineSourceError(
+                                "No track has been loaded with the name "
+                                f"{pipeline.source} yet. Is your recipe "
+                                f"correct? Pipeline: {pipeline}"
+                            )
+
+                    # The heavy lifting in each action happens in compiled
+                    # code which releases the GIL, so threads are enough
+                    tracks = executor.map(
+                        lambda index: self._run_pipeline(
+                            pipelines[index],
+                            reuses[index][1] if index in reuses else None,
+                            offers.get(index),
+                            index in exclusive,
+                            fft_workers,
+                        ),
+                        stage,
+                    )
+
+                    # It is OK to overwrite sources with sinks, so no need to
+                    # check
+                    for index, track in zip(stage, tracks):
+                        self.tracks[pipelines[index].sink] = track
+                        progress.update()
+
+                    # Drop cached prefixes once nothing else will reuse them
+                    for index in stage:
+                        if index in reuses:
+                            _, key = reuses[index]
+                            remaining[key] -= 1
+                            if remaining[key] == 0:
+                                del self._prefixes[key]
 
     def _save(self) -> None:
-        for name in tqdm(self.tracks, desc="Preparing to merge tracks..."):
+        for name in tqdm(
+            self.tracks, desc="Preparing to merge tracks...", disable=None
+        ):
             track = self.tracks[name]
             if track.save:
-                filename = f"./{self.target}/{name}.wav"
-                self._save_track(filename, track)
-                self._saved_files.append(filename)
+                self._saved_tracks.append(track)
 
     def _merge(self, output_file: str) -> None:
-        merged_audio = AudioMerger.merge(self._saved_files)
+        merged_audio = AudioMerger.merge(self._saved_tracks)
         AudioMerger.save_file(output_file, merged_audio)
 
     def process(self, pipelines: List[Pipeline], output_file: str) -> None:
@@ -96,38 +331,79 @@ class PipelineProcessor:
 
 class AudioMerger:
     @staticmethod
-    def merge(files: List[str]) -> AudioSegment:
-        """Merge the list of audio sources into an AudioSegment
+    def merge(tracks: List[Track]) -> AudioSegment:
+        """Merge the list of audio tracks into an AudioSegment
+
+        The tracks are mixed by summing their samples, and the mix is scaled
+        down to fit the range of 16-bit audio if it would otherwise clip.
+        Mono tracks are mixed into every channel of the output.
 
         Args:
-            files: List of track sources to merge
+            tracks: List of tracks to merge
 
         Raises:
-            InvalidInputError: If no files were provided to merge, then this
+            InvalidInputError: If no tracks were provided to merge, then this
                 is likely the result of a bad input recipe.
-            MergingError: If the tracks are unabled to be merged
+            MergingError: If the tracks are unable to be merged
 
         Returns:
             The overlaid tracks merged into an AudioSegment
         """
-        if len(files) == 0:
+        if len(tracks) == 0:
             raise InvalidInputError(
-                "No files were provided to merge. There is likely an issue "
+                "No tracks were provided to merge. There is likely an issue "
                 "with the input recipe."
             )
 
-        try:
-            merged = AudioSegment.from_wav(files[0])
+        sample_rate = tracks[0].sample_rate
+        if any(track.sample_rate != sample_rate for track in tracks):
+            raise MergingError(
+                "Unable to combine tracks with different sample rates: "
+                f"{[track.sample_rate for track in tracks]}"
+            )
 
-            if len(files) > 1:
-                for f in tqdm(files[1:], "Merging tracks..."):
-                    audio = AudioSegment.from_wav(f)
-                    merged = merged.overlay(audio)
+        num_samples = max(len(track.audio) for track in tracks)
+        num_channels = max(track.num_channels for track in tracks)
+        merged = np.zeros((num_samples, num_channels), dtype=np.float32)
+        for track in tqdm(tracks, "Merging tracks...", disable=None):
+            audio = track.audio
+            if audio.ndim == 1:
+                audio = audio[:, np.newaxis]
+            np.add(merged[: len(audio)], audio, out=merged[: len(audio)])
 
-            return merged
+        # Scale the whole mix down rather than clipping its loudest samples.
+        # Taking the peak from the extremes avoids a full-size abs() buffer.
+        peak = max(merged.max(), -merged.min())
+        if peak > 1.0:
+            merged /= peak
+        pcm = (merged * np.iinfo(np.int16).max).astype(np.int16)
+
+        try:
+            return AudioSegment(
+                pcm.tobytes(),
+                sample_width=pcm.itemsize,
+                frame_rate=sample_rate,
+                channels=num_channels,
+            )
         except PydubException:
             raise MergingError(
-                f"Unable to combine tracks backed by files: {files}"
+                f"Unable to combine {len(tracks)} tracks into one track"
+            )
+
+    @staticmethod
+    def _save_mp3(filename: str, audio: AudioSegment) -> None:
+        encoder = _lameenc.Encoder()
+        encoder.set_bit_rate(_MP3_BIT_RATE)
+        encoder.set_in_sample_rate(audio.frame_rate)
+        encoder.set_channels(audio.channels)
+        encoder.set_quality(_MP3_QUALITY)
+        try:
+            mp3 = encoder.encode(audio.raw_data) + encoder.flush()
+            with open(filename, "wb") as f:
+                f.write(mp3)
+        except (OSError, RuntimeError):
+            raise MergingError(
+                f"Unable to save merged track to file {filename}"
             )
 
     @staticmethod
@@ -141,6 +417,16 @@ class AudioMerger:
         Raises:
             MergingError: If unable to save the merged track
         """
+        # Encoding in-process avoids piping the mix through an ffmpeg
+        # subprocess, but lameenc only handles 16-bit mono and stereo audio
+        if (
+            _lameenc is not None
+            and audio.sample_width == 2
+            and audio.channels <= 2
+        ):
+            AudioMerger._save_mp3(filename, audio)
+            return
+
         try:
             audio.export(filename, format="mp3")
         except PydubException:
@@ -1,49 +1,171 @@
-from abc import ABC, abstractmethod
 from enum import Enum, auto
-from typing import List
+from typing import Dict, Iterable, List, Type
 
+import numpy as np
 from spleeter import SpleeterError
+from spleeter.audio.adapter import AudioAdapter
+from spleeter.model.provider import ModelProvider
 from spleeter.separator import Separator
+from spleeter.utils.configuration import load_configuration
 
 from brownify.errors import InvalidInputError, SplittingError
 
+# Spleeter models all operate on 44.1kHz audio
+_SAMPLE_RATE = 44100
 
-class AudioSplitter(ABC):
-    """Abstract class for an object that splits audio files into sources
+
+class AudioSplitter:
+    """Base class for an object that splits audio files into sources
 
     AudioSplitter is the top of the class hierarchy for objects which can
-    take in audio files and split them into multiple separated sources
+    take in audio files and split them into multiple separated sources. It
+    cannot be used directly, and every subclass must declare MODEL and
+    CHANNELS.
     """
 
+    # Concrete splitters only differ in the model they load and the channels
+    # it creates, so they just declare MODEL and CHANNELS
+    MODEL: str
+    CHANNELS: List[str]
+    SAMPLE_RATE = _SAMPLE_RATE
     separator: Separator
 
-    @abstractmethod
-    def _init_separator(self) -> None:
-        """Initialize the separator
+    # Separators are shared by every splitter which uses the same model, so
+    # the estimator a separator creates on its first split is reused. Spleeter
+    # still builds the model graph and restores its checkpoint on every call
+    # to separate, so the cache does not keep a model loaded between splits.
+    _separator_cache: Dict[str, Separator] = {}
+
+    @staticmethod
+    def _get_separator(model: str) -> Separator:
+        separator = AudioSplitter._separator_cache.get(model)
+        if separator is None:
+            # Multiprocessing is only used by Spleeter to write files in the
+            # background, and a process pool is costly to spin up
+            separator = Separator(model, multiprocess=False)
+            AudioSplitter._separator_cache[model] = separator
+        return separator
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        missing = [
+            name for name in ("MODEL", "CHANNELS") if not hasattr(cls, name)
+        ]
+        if missing:
+            raise TypeError(
+                f"{cls.__name__} must declare {' and '.join(missing)}"
+            )
 
-        Each concrete implementation of a separator must implement this method
-        to initialize its separator.
+    @classmethod
+    def _check_concrete(cls) -> None:
+        # Only the base class can lack a model, since every subclass is
+        # checked when it is defined
+        if cls is AudioSplitter:
+            raise TypeError(
+                "AudioSplitter cannot be used directly, use one of its "
+                "subclasses instead"
+            )
+
+    @classmethod
+    def warmup(cls) -> None:
+        """Fetch the files of the separation model ahead of the first split
+
+        Spleeter downloads a model the first time it is used, so fetching it
+        here lets the download overlap other work. The model itself is still
+        loaded by each split.
+
+        Raises:
+            SplittingError: If the model files cannot be fetched
         """
+        cls._check_concrete()
+        try:
+            model_dir = load_configuration(cls.MODEL)["model_dir"]
+            ModelProvider.default().get(model_dir)
+        except (OSError, SpleeterError):
+            raise SplittingError(
+                f"Unable to fetch the files for the {cls.MODEL} model"
+            )
+
+    def __init__(self):
+        self._check_concrete()
+        self._init_separator()
+
+    def _init_separator(self) -> None:
+        self.separator = self._get_separator(self.MODEL)  # pragma: no cover
 
-    @abstractmethod
     def get_channels(self) -> List[str]:
         """Get the list of named of channels that the splitter will create"""
+        return self.CHANNELS
 
-    def split(self, filename: str) -> None:
-        """Split an audio file into multiple sources
+    @classmethod
+    def load(cls, filename: str) -> np.ndarray:
+        """Load an audio file into a waveform which can be split
 
         Args:
-            filename (str): Path to the file which should be split into
-                multiple sources
+            filename (str): Path to the audio file to load
 
         Raises:
-            SplittingError: If unable to perform the operation of splitting
-                into multiple tracks
+            SplittingError: If unable to load the audio file
+
+        Returns:
+            np.ndarray: Waveform sampled at SAMPLE_RATE with shape
+                (samples, channels)
         """
         try:
-            self.separator.separate_to_file(filename, ".")
+            waveform, _ = AudioAdapter.default().load(
+                filename, sample_rate=cls.SAMPLE_RATE
+            )
         except SpleeterError:
-            raise SplittingError("Unable to split into separate tracks")
+            raise SplittingError(f"Unable to load {filename} for splitting")
+        return waveform
+
+    def split(self, waveform: np.ndarray) -> Dict[str, np.ndarray]:
+        """Split a waveform into multiple sources
+
+        Args:
+            waveform (np.ndarray): Waveform sampled at SAMPLE_RATE with shape
+                (samples, channels)
+
+        Raises:
+            SplittingError: If unable to perform the operation of splitting
+                into multiple tracks
+
+        Returns:
+            Dict[str, np.ndarray]: The separated sources, keyed by the names
+                from get_channels()
+        """
+        return self.split_all([waveform])[0]
+
+    def split_all(
+        self, waveforms: List[np.ndarray]
+    ) -> List[Dict[str, np.ndarray]]:
+        """Split several waveforms into multiple sources
+
+        The waveforms are run through the same separator one at a time.
+        Spleeter loads the model again for each of them, so this costs the
+        same as calling split on every waveform.
+
+        Args:
+            waveforms (List[np.ndarray]): Waveforms sampled at SAMPLE_RATE
+                with shape (samples, channels)
+
+        Raises:
+            SplittingError: If unable to perform the operation of splitting
+                any of the waveforms into multiple tracks
+
+        Returns:
+            List[Dict[str, np.ndarray]]: The separated sources of each
+                waveform, in the same order as the waveforms
+        """
+        sources = []
+        for waveform in waveforms:
+            try:
+                sources.append(self.separator.separate(waveform))
+            except SpleeterError:
+                raise SplittingError(
+                    "Unable to split audio into separate tracks"
+                )
+        return sources
 
 
 class AudioSplitter5Channel(AudioSplitter):
@@ -55,6 +177,7 @@ class AudioSplitter5Channel(AudioSplitter):
     a less clean separation than the other splitters with fewer tracks.
     """
 
+    MODEL = "spleeter:5stems"
     CHANNELS = [
         "bass",
         "drums",
@@ -63,15 +186,6 @@ class AudioSplitter5Channel(AudioSplitter):
         "vocals",
     ]
 
-    def __init__(self):
-        self._init_separator()
-
-    def _init_separator(self) -> None:
-        self.separator = Separator("spleeter:5stems")  # pragma: no cover
-
-    def get_channels(self) -> List[str]:
-        return self.CHANNELS
-
 
 class AudioSplitter4Channel(AudioSplitter):
     """Split a file into bass, drums, vocals, and other tracks
@@ -82,6 +196,7 @@ class AudioSplitter4Channel(AudioSplitter):
     clean separation than the other splitters with fewer tracks.
     """
 
+    MODEL = "spleeter:4stems"
     CHANNELS = [
         "bass",
         "drums",
@@ -89,38 +204,22 @@ class AudioSplitter4Channel(AudioSplitter):
         "vocals",
     ]
 
-    def __init__(self):
-        self._init_separator()
-
-    def _init_separator(self) -> None:
-        self.separator = Separator("spleeter:4stems")  # pragma: no cover
-
-    def get_channels(self) -> List[str]:
-        return self.CHANNELS
-
 
 class AudioSplitter2Channel(AudioSplitter):
-    """Split a file into vocal and other tracks
+    """Split a file into vocal and accompaniment tracks
 
     AudioSplitter2Channel objects can split a single track into separate
-    voice and other tracks. It may provide the cleanest track separation
-    if only vocal isolation is desired.
+    voice and accompaniment tracks, where the accompaniment holds everything
+    but the voice. It may provide the cleanest track separation if only
+    vocal isolation is desired.
     """
 
+    MODEL = "spleeter:2stems"
     CHANNELS = [
-        "other",
+        "accompaniment",
         "vocals",
     ]
 
-    def __init__(self):
-        self._init_separator()
-
-    def _init_separator(self) -> None:
-        self.separator = Separator("spleeter:2stems")  # pragma: no cover
-
-    def get_channels(self) -> List[str]:
-        return self.CHANNELS
-
 
 class AudioSplitterType(Enum):
     """Enumerate AudioSplitter types for the AudioSplitterFactory"""
@@ -130,9 +229,41 @@ class AudioSplitterType(Enum):
     FIVE_STEM = auto()
 
 
+_SPLITTERS: Dict[AudioSplitterType, Type[AudioSplitter]] = {
+    AudioSplitterType.ONLY_VOCALS: AudioSplitter2Channel,
+    AudioSplitterType.FOUR_STEM: AudioSplitter4Channel,
+    AudioSplitterType.FIVE_STEM: AudioSplitter5Channel,
+}
+
+
 class AudioSplitterFactory:
     """Factory class for creating AudioSplitter objects"""
 
+    @staticmethod
+    def get_audio_splitter_type(channels: Iterable[str]) -> AudioSplitterType:
+        """Method for choosing the smallest AudioSplitter for some channels
+
+        Models with fewer stems run faster, so the smallest model which
+        separates every requested channel is chosen. The "other" channel only
+        selects the five stem model, since the four stem model folds piano
+        into it, while the "accompaniment" channel is only created by the
+        two stem model.
+
+        Args:
+            channels (Iterable[str]): Names of the channels which are needed
+
+        Returns:
+            AudioSplitterType: Type of the smallest AudioSplitter providing
+                all of the channels
+        """
+        needed = set(channels)
+        if needed <= {"accompaniment", "vocals"}:
+            return AudioSplitterType.ONLY_VOCALS
+        elif needed <= {"bass", "drums", "vocals"}:
+            return AudioSplitterType.FOUR_STEM
+        else:
+            return AudioSplitterType.FIVE_STEM
+
     @staticmethod
     def get_audio_splitter(
         audio_splitter_type: AudioSplitterType = AudioSplitterType.FIVE_STEM,
@@ -147,13 +278,9 @@ class AudioSplitterFactory:
         Returns:
             AudioSplitter: A concrete instance of an AudioSplitter
         """
-        if audio_splitter_type == AudioSplitterType.ONLY_VOCALS:
-            return AudioSplitter2Channel()
-        elif audio_splitter_type == AudioSplitterType.FOUR_STEM:
-            return AudioSplitter4Channel()
-        elif audio_splitter_type == AudioSplitterType.FIVE_STEM:
-            return AudioSplitter5Channel()
-        else:
+        splitter_cls = _SPLITTERS.get(audio_splitter_type)
+        if splitter_cls is None:
             raise InvalidInputError(
                 f"Unknown splitter type provided: {audio_splitter_type}"
             )
+        return splitter_cls()
@@ -1,6 +1,10 @@
+from unittest import mock
+
+import librosa
 import numpy as np
 import pytest
 
+from brownify import actions
 from brownify.actions import Brownifier
 from brownify.models import Track
 
@@ -32,107 +36,238 @@ def dummy_stereo_track():
 
 def test_change_pitch_mono_null(dummy_mono_track):
     track = dummy_mono_track.clone()
-    track = Brownifier.change_pitch(track, 0)
+    track = Brownifier.materialize(Brownifier.change_pitch(track, 0))
     assert np.allclose(track.audio, dummy_mono_track.audio)
 
 
 def test_change_pitch_mono_up(dummy_mono_track):
     track = dummy_mono_track.clone()
-    track = Brownifier.change_pitch(track, 1)
+    track = Brownifier.materialize(Brownifier.change_pitch(track, 1))
     assert not np.allclose(track.audio, dummy_mono_track.audio)
 
 
 def test_change_pitch_mono_down(dummy_mono_track):
     track = dummy_mono_track.clone()
-    track = Brownifier.change_pitch(track, -1)
+    track = Brownifier.materialize(Brownifier.change_pitch(track, -1))
     assert not np.allclose(track.audio, dummy_mono_track.audio)
 
 
 def test_change_pitch_stereo_up(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.change_pitch(track, 1)
+    track = Brownifier.materialize(Brownifier.change_pitch(track, 1))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_change_pitch_stereo_down(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.change_pitch(track, -1)
+    track = Brownifier.materialize(Brownifier.change_pitch(track, -1))
+    assert not np.allclose(track.audio, dummy_stereo_track.audio)
+
+
+def test_change_pitch_keeps_shape(dummy_mono_track, dummy_stereo_track):
+    single_channel = Track(
+        audio=dummy_mono_track.audio[:, np.newaxis],
+        num_channels=1,
+        sample_rate=dummy_mono_track.sample_rate,
+        save=False,
+    )
+    for dummy_track in (dummy_mono_track, dummy_stereo_track, single_channel):
+        track = Brownifier.materialize(
+            Brownifier.change_pitch(dummy_track.clone(), 1)
+        )
+        assert track.audio.shape == dummy_track.audio.shape
+
+
+def test_change_pitch_stereo_matches_per_channel(dummy_stereo_track):
+    # Both channels are shifted in one batch, which must give the same result
+    # as shifting each channel on its own
+    with mock.patch.object(actions, "_Stretch", None):
+        track = Brownifier.materialize(
+            Brownifier.change_pitch(dummy_stereo_track.clone(), -1)
+        )
+    for channel in range(2):
+        expected = librosa.effects.pitch_shift(
+            dummy_stereo_track.audio[:, channel].astype(np.float64),
+            sr=dummy_stereo_track.sample_rate,
+            n_steps=-1,
+            res_type="kaiser_fast",
+        )
+        assert np.allclose(track.audio[:, channel], expected, atol=1e-2)
+
+
+def test_change_pitch_uses_stretch(dummy_stereo_track):
+    mock_stretch = mock.MagicMock()
+    mock_stretch.return_value.process.side_effect = lambda audio: audio
+    with mock.patch.object(actions, "_Stretch", mock_stretch):
+        track = Brownifier.materialize(
+            Brownifier.change_pitch(dummy_stereo_track.clone(), -1)
+        )
+
+    mock_stretch.return_value.preset.assert_called_once_with(2, 12345.0)
+    mock_stretch.return_value.setTransposeSemitones.assert_called_once_with(
+        -1.0
+    )
+    assert track.audio.shape == dummy_stereo_track.audio.shape
+
+
+def test_change_pitch_fast(dummy_stereo_track):
+    track = dummy_stereo_track.clone()
+    track.sample_rate = 44100
+    with mock.patch.object(actions, "_Stretch", None):
+        track = Brownifier.materialize(
+            Brownifier.change_pitch(track, -1), fast=True
+        )
+    assert track.audio.shape == dummy_stereo_track.audio.shape
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
+def test_change_pitch_uses_gpu(dummy_stereo_track):
+    track = dummy_stereo_track.clone()
+    with mock.patch.object(
+        actions.actions_gpu, "is_available", return_value=True
+    ), mock.patch.object(
+        actions.actions_gpu,
+        "pitch_shift",
+        side_effect=lambda audio2d, *args: audio2d,
+    ) as mock_pitch_shift:
+        track = Brownifier.materialize(Brownifier.change_pitch(track, 1))
+    mock_pitch_shift.assert_called_once()
+    assert track.audio.shape == dummy_stereo_track.audio.shape
+
+
+def test_chained_pitch_changes_are_fused(dummy_stereo_track):
+    track = Brownifier.octave_up(Brownifier.sharp(dummy_stereo_track.clone()))
+    assert track.pending_semitones == 13.0
+    assert np.array_equal(track.audio, dummy_stereo_track.audio)
+
+    with mock.patch.object(
+        actions, "_pitch_shift", wraps=actions._pitch_shift
+    ) as mock_pitch_shift:
+        track = Brownifier.materialize(track)
+
+    mock_pitch_shift.assert_called_once()
+    assert mock_pitch_shift.call_args.args[2:] == (13.0, 12, False, None)
+    assert track.pending_semitones == 0.0
+
+
+def test_cancelling_changes_leave_audio_untouched(dummy_stereo_track):
+    track = Brownifier.flat(Brownifier.sharp(dummy_stereo_track.clone()))
+    track = Brownifier.late(Brownifier.early(track))
+    track = Brownifier.materialize(track)
+    assert np.array_equal(track.audio, dummy_stereo_track.audio)
+
+
 def test_sharp(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.sharp(track)
+    track = Brownifier.materialize(Brownifier.sharp(track))
     assert not np.all(np.array_equal(track.audio, dummy_stereo_track.audio))
 
 
 def test_flat(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.flat(track)
+    track = Brownifier.materialize(Brownifier.flat(track))
     assert not np.all(np.array_equal(track.audio, dummy_stereo_track.audio))
 
 
 def test_half_sharp(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.half_sharp(track)
+    track = Brownifier.materialize(Brownifier.half_sharp(track))
     assert not np.all(np.array_equal(track.audio, dummy_stereo_track.audio))
 
 
 def test_half_flat(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.half_flat(track)
+    track = Brownifier.materialize(Brownifier.half_flat(track))
     assert not np.all(np.array_equal(track.audio, dummy_stereo_track.audio))
 
 
 def test_octave_up(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.octave_up(track)
+    track = Brownifier.materialize(Brownifier.octave_up(track))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_octave_down(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.octave_down(track)
+    track = Brownifier.materialize(Brownifier.octave_down(track))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_time_shift_mono_forward(dummy_mono_track):
     track = dummy_mono_track.clone()
-    track = Brownifier.time_shift(track, 100)
+    track = Brownifier.materialize(Brownifier.time_shift(track, 100))
     assert not np.allclose(track.audio, dummy_mono_track.audio)
 
 
 def test_time_shift_mono_backward(dummy_mono_track):
     track = dummy_mono_track.clone()
-    track = Brownifier.time_shift(track, -100)
+    track = Brownifier.materialize(Brownifier.time_shift(track, -100))
     assert not np.allclose(track.audio, dummy_mono_track.audio)
 
 
 def test_time_shift_stereo_forward(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.time_shift(track, 100)
+    track = Brownifier.materialize(Brownifier.time_shift(track, 100))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_time_shift_stereo_backward(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.time_shift(track, -100)
+    track = Brownifier.materialize(Brownifier.time_shift(track, -100))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
+@pytest.mark.parametrize("seconds_shift", [0.01, -0.01, 0.15, -0.15])
+def test_time_shift_matches_roll(dummy_stereo_track, seconds_shift):
+    track = dummy_stereo_track.clone()
+    track = Brownifier.materialize(Brownifier.time_shift(track, seconds_shift))
+    samples_shift = round(seconds_shift * dummy_stereo_track.sample_rate)
+    expected = np.roll(dummy_stereo_track.audio, samples_shift, axis=0)
+    assert np.array_equal(track.audio, expected)
+
+
+def test_time_shift_empty_track():
+    track = Track(
+        audio=np.zeros((0, 2)), num_channels=2, sample_rate=12345, save=False
+    )
+    track = Brownifier.materialize(Brownifier.early(track))
+    assert track.audio.shape == (0, 2)
+
+
 def test_null_time_shift(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.time_shift(track, 0)
+    track = Brownifier.materialize(Brownifier.time_shift(track, 0))
     assert np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_early(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.early(track)
+    track = Brownifier.materialize(Brownifier.early(track))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
 
 
 def test_late(dummy_stereo_track):
     track = dummy_stereo_track.clone()
-    track = Brownifier.late(track)
+    track = Brownifier.materialize(Brownifier.late(track))
     assert not np.allclose(track.audio, dummy_stereo_track.audio)
+
+
+def test_warmup():
+    with mock.patch.object(
+        actions, "_pitch_shift", wraps=actions._pitch_shift
+    ) as mock_pitch_shift, mock.patch.object(
+        actions, "_roll_inplace", wraps=actions._roll_inplace
+    ) as mock_roll:
+        Brownifier.warmup(12345)
+    mock_pitch_shift.assert_called_once()
+    mock_roll.assert_called_once()
+
+
+def test_has_fast_pitch():
+    with mock.patch.object(actions, "_Stretch", None), mock.patch.object(
+        actions.actions_gpu, "is_available", return_value=False
+    ):
+        assert Brownifier.has_fast_pitch()
+
+    with mock.patch.object(actions, "_Stretch", mock.MagicMock()):
+        assert not Brownifier.has_fast_pitch()
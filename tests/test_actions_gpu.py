@@ -0,0 +1,29 @@
+from unittest import mock
+
+import numpy as np
+
+from brownify import actions_gpu
+
+
+def test_is_available_without_torch():
+    with mock.patch.object(actions_gpu, "torch", None):
+        assert not actions_gpu.is_available()
+
+
+def test_pitch_shift():
+    audio = np.random.rand(2, 2048).astype(np.float32)
+    mock_torch = mock.MagicMock()
+    mock_torchaudio = mock.MagicMock()
+    shifted = mock_torchaudio.functional.pitch_shift.return_value
+    shifted.cpu.return_value.numpy.return_value = audio
+    with mock.patch.object(
+        actions_gpu, "torch", mock_torch
+    ), mock.patch.object(actions_gpu, "torchaudio", mock_torchaudio):
+        result = actions_gpu.pitch_shift(audio, 12345, 0.5, 12, 2048, 512)
+
+    assert result is audio
+    mock_torch.from_numpy.return_value.cuda.assert_called_once()
+    args, kwargs = mock_torchaudio.functional.pitch_shift.call_args
+    # Half a semitone is one step of a 24 step octave
+    assert args[1:] == (12345, 1)
+    assert kwargs["bins_per_octave"] == 24
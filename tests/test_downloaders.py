@@ -1,10 +1,12 @@
 from unittest import mock
 
+import ffmpeg
+import numpy as np
 import pytest
 import yt_dlp
 
 from brownify.downloaders import YoutubeDownloader
-from brownify.errors import NoAudioStreamFoundError
+from brownify.errors import DownloadError, NoAudioStreamFoundError
 
 
 @pytest.fixture
@@ -32,3 +34,47 @@ def test_youtube_downloader_get_audio_no_stream_found(
     ):
         with pytest.raises(NoAudioStreamFoundError):
             YoutubeDownloader.get_audio(dummy_url, dummy_outfile)
+
+
+@pytest.fixture
+def dummy_info():
+    return {"url": "dummy", "http_headers": {"User-Agent": "dummy"}}
+
+
+def test_youtube_downloader_get_waveform_success(dummy_url, dummy_info):
+    pcm = np.arange(8, dtype=np.float32)
+    with mock.patch.object(
+        yt_dlp.YoutubeDL, "extract_info", return_value=dummy_info
+    ):
+        with mock.patch.object(
+            ffmpeg.nodes.OutputStream,
+            "run",
+            return_value=(pcm.tobytes(), b""),
+        ):
+            waveform = YoutubeDownloader.get_waveform(dummy_url, 44100)
+
+    assert waveform.shape == (4, 2)
+    assert np.array_equal(waveform.ravel(), pcm)
+
+
+def test_youtube_downloader_get_waveform_no_stream_found(dummy_url):
+    with mock.patch.object(
+        yt_dlp.YoutubeDL,
+        "extract_info",
+        side_effect=yt_dlp.utils.DownloadError("Not found"),
+    ):
+        with pytest.raises(NoAudioStreamFoundError):
+            YoutubeDownloader.get_waveform(dummy_url, 44100)
+
+
+def test_youtube_downloader_get_waveform_decode_failure(dummy_url, dummy_info):
+    with mock.patch.object(
+        yt_dlp.YoutubeDL, "extract_info", return_value=dummy_info
+    ):
+        with mock.patch.object(
+            ffmpeg.nodes.OutputStream,
+            "run",
+            side_effect=ffmpeg.Error("ffmpeg", b"", b""),
+        ):
+            with pytest.raises(DownloadError):
+                YoutubeDownloader.get_waveform(dummy_url, 44100)
@@ -29,3 +29,28 @@ def test_clone_track(dummy_track):
 
     # Make sure that the cloned track has save set to false by default
     assert not dummy_track_clone.save
+
+
+def test_clone_track_copy_on_write(dummy_track):
+    original_audio = np.copy(dummy_track.audio)
+    dummy_track_clone = dummy_track.clone()
+
+    # The clone should not be able to modify the original track's audio
+    assert not dummy_track_clone.audio.flags.writeable
+    with pytest.raises(ValueError):
+        dummy_track_clone.audio[0, 0] = 0
+
+    # Asking for writable audio should copy it away from the original track
+    dummy_track_clone.writable_audio()[0, 0] = 0
+    assert np.array_equal(dummy_track.audio, original_audio)
+    assert dummy_track_clone.audio[0, 0] == 0
+
+
+def test_track_audio_float32():
+    track = Track(
+        audio=np.array([0.5, -0.5], dtype=np.float64),
+        num_channels=1,
+        sample_rate=12345,
+        save=False,
+    )
+    assert track.audio.dtype == np.float32
@@ -1,7 +1,9 @@
+import pyparsing as pp
 import pytest
 
+from brownify import parsers
 from brownify.errors import InvalidInputError, UnexpectedTokenTypeError
-from brownify.parsers import ActionParser
+from brownify.parsers import ActionParser, get_parser
 
 
 @pytest.fixture
@@ -59,6 +61,13 @@ def missing_sink_program():
     return program
 
 
+@pytest.fixture(scope="module")
+def parser():
+    # ActionParser holds no per-recipe state, so one instance serves every
+    # test in the module
+    return ActionParser()
+
+
 @pytest.fixture
 def invalid_action_program():
     program = """
@@ -67,8 +76,7 @@ def invalid_action_program():
     return program
 
 
-def test_get_pipelines(dummy_program, dummy_program_num_pipelines):
-    parser = ActionParser()
+def test_get_pipelines(parser, dummy_program, dummy_program_num_pipelines):
     pipelines = parser.get_pipelines(dummy_program)
 
     # Check that number of pipelines is correct
@@ -83,9 +91,8 @@ def test_get_pipelines(dummy_program, dummy_program_num_pipelines):
 
 
 def test_get_pipelines_whitespace(
-    dummy_program_whitespace, dummy_program_num_pipelines
+    parser, dummy_program_whitespace, dummy_program_num_pipelines
 ):
-    parser = ActionParser()
     pipelines = parser.get_pipelines(dummy_program_whitespace)
 
     # Check that number of pipelines is correct
@@ -99,25 +106,71 @@ def test_get_pipelines_whitespace(
     assert sample_pipeline.save
 
 
-def test_get_pipelines_missing_semicolon(missing_semicolon_program):
-    parser = ActionParser()
+def test_get_pipelines_missing_semicolon(parser, missing_semicolon_program):
     with pytest.raises(InvalidInputError):
         parser.get_pipelines(missing_semicolon_program)
 
 
-def test_get_pipelines_missing_source(missing_source_program):
-    parser = ActionParser()
+def test_get_pipelines_missing_source(parser, missing_source_program):
     with pytest.raises(InvalidInputError):
         parser.get_pipelines(missing_source_program)
 
 
-def test_get_pipelines_missing_sink(missing_sink_program):
-    parser = ActionParser()
+def test_get_pipelines_missing_sink(parser, missing_sink_program):
     with pytest.raises(UnexpectedTokenTypeError):
         parser.get_pipelines(missing_sink_program)
 
 
-def test_get_pipelines_invalid_action(invalid_action_program):
-    parser = ActionParser()
+def test_get_pipelines_invalid_action(parser, invalid_action_program):
     with pytest.raises(InvalidInputError):
         parser.get_pipelines(invalid_action_program)
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        "vocals -> save(vocals);",
+        "vocals->flat->late->v;v->drop",
+        "\n piano ->\tsave( p );\n p -> octaveup -> flat ;\n",
+    ],
+)
+def test_scan_matches_grammar(parser, program):
+    assert parser._scan(program) == parser._parse(program)
+
+
+def test_scan_rejects_invalid_recipes(
+    parser,
+    missing_semicolon_program,
+    missing_source_program,
+    invalid_action_program,
+):
+    for program in [
+        missing_semicolon_program,
+        missing_source_program,
+        invalid_action_program,
+        "",
+        "vocals -> v;;",
+    ]:
+        assert parser._scan(program) is None
+
+
+def test_get_parser_shared():
+    parser = get_parser()
+    assert isinstance(parser, ActionParser)
+    assert get_parser() is parser
+
+
+def test_action_parsers_share_grammar():
+    assert ActionParser()._pipelines is ActionParser()._pipelines
+
+
+def test_grammar_built_lazily(parser, dummy_program):
+    parsers._get_grammar.cache_clear()
+    parser.get_pipelines(dummy_program)
+    assert parsers._get_grammar.cache_info().currsize == 0
+
+
+def test_packrat_enabled():
+    # The recipe grammar has no side effects in its parse actions, so the
+    # parsers module turns on packrat memoization when it is imported
+    assert pp.ParserElement._packratEnabled
@@ -1,68 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import numpy as np
 import pytest
-import soundfile as sf
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
+from pydub.exceptions import CouldntEncodeError
 
+from brownify import actions
 from brownify.actions import Brownifier
 from brownify.errors import (
     InvalidInputError,
     MergingError,
     NoPipelineSourceError,
 )
-from brownify.models import Pipeline
+from brownify.models import Pipeline, Track
 from brownify.runners import AudioMerger, PipelineProcessor
-from brownify.splitters import AudioSplitter
 
 
-class MockSplitter(AudioSplitter):
-    def _init_separator(self) -> None:
-        """Must implement this abstract method for test"""
-
-    def get_channels(self):
-        return ["voice"]
-
-
-class MockFailingAudioSegment(AudioSegment):
-    def __init__(self):
-        pass
-
+class MockFailingAudioSegment:
+    # AudioMerger.save_file only exports the segment, so there is no need to
+    # build a real AudioSegment
     def export(self, filename, format):
         raise CouldntEncodeError(f"Couldn't encode {filename} to {format}")
 
 
-def mock_soundfile_read(filename):
-    return np.random.rand(2048) * 1000, 12345
-
-
-def mock_soundfile_write(filename, audio, sample_rate):
-    pass
-
-
-def mock_audio_segment_from_wav_fail(filename):
-    raise CouldntDecodeError(f"Failed to decode dummy file {filename}")
-
-
+# Fixtures which are never modified by the tests are shared by the whole
+# module. Sources and tracks are rebuilt for every test, since processing may
+# modify their audio in place.
 @pytest.fixture
-def dummy_splitter():
-    return MockSplitter()
+def dummy_sources():
+    return {"voice": np.random.rand(2048).astype(np.float32)}
 
 
-@pytest.fixture
-def dummy_target():
-    return "dummy"
+@pytest.fixture(scope="module")
+def dummy_sample_rate():
+    return 12345
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def dummy_pipeline():
     return Pipeline(
         source="voice", actions=[Brownifier.flat], sink="newvoice", save=True
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def missing_source_pipeline():
     return Pipeline(
         source="missing", actions=[Brownifier.flat], sink="newvoice", save=True
@@ -70,11 +51,30 @@ def missing_source_pipeline():
 
 
 @pytest.fixture
-def dummy_files():
-    return ["file1", "file2"]
+def dummy_tracks():
+    return [
+        Track(
+            audio=np.array([[0.5, -0.5], [0.25, 0.0]], dtype=np.float32),
+            num_channels=2,
+            sample_rate=12345,
+            save=True,
+        ),
+        Track(
+            audio=np.array([0.75, 0.25, -0.5], dtype=np.float32),
+            num_channels=1,
+            sample_rate=12345,
+            save=True,
+        ),
+    ]
 
 
 @pytest.fixture
+def mismatched_tracks(dummy_tracks):
+    dummy_tracks[1].sample_rate = 54321
+    return dummy_tracks
+
+
+@pytest.fixture(scope="module")
 def dummy_filename():
     return "file1"
 
@@ -84,40 +84,333 @@ def dummy_failing_audio_segment():
     return MockFailingAudioSegment()
 
 
-def test_pipeline_processor(dummy_target, dummy_splitter, dummy_pipeline):
-    with mock.patch.object(sf, "read", new=mock_soundfile_read):
-        with mock.patch.object(sf, "write", new=mock_soundfile_write):
-            processor = PipelineProcessor(dummy_target, dummy_splitter)
-            processor._merge = mock.MagicMock()
-            processor.process([dummy_pipeline], "test")
+def test_pipeline_processor(dummy_sources, dummy_sample_rate, dummy_pipeline):
+    original_audio = np.copy(dummy_sources["voice"])
+    processor = PipelineProcessor(dummy_sources, dummy_sample_rate)
+    processor._merge = mock.create_autospec(processor._merge)
+    processor.process([dummy_pipeline], "test")
+
+    expected = Brownifier.materialize(
+        Brownifier.flat(
+            Track(
+                audio=original_audio,
+                num_channels=1,
+                sample_rate=dummy_sample_rate,
+                save=False,
+            )
+        )
+    )
+    track = processor.tracks["newvoice"]
+    assert track.num_channels == 1
+    assert track.sample_rate == dummy_sample_rate
+    assert track.save
+    assert np.allclose(track.audio, expected.audio)
+
+    # The pipeline writes to its sink, so its source is left as it was
+    assert np.array_equal(processor.tracks["voice"].audio, original_audio)
+
+
+def test_pipeline_processor_assume_mono_stems(dummy_sample_rate):
+    rng = np.random.default_rng(0)
+    mono = rng.random(2048, dtype=np.float32)
+    sources = {
+        "mono": np.stack([mono, mono], axis=1),
+        "stereo": rng.random((2048, 2), dtype=np.float32),
+    }
+
+    processor = PipelineProcessor(sources, dummy_sample_rate)
+    assert processor.tracks["mono"].num_channels == 2
+
+    processor = PipelineProcessor(
+        sources, dummy_sample_rate, assume_mono_stems=True
+    )
+    assert processor.tracks["mono"].num_channels == 1
+    assert np.allclose(processor.tracks["mono"].audio, mono)
+    assert processor.tracks["stereo"].num_channels == 2
+
+
+def test_pipeline_processor_is_mono():
+    rng = np.random.default_rng(0)
+    n_samples = 44100
+    intro = n_samples // 4
+    stereo = rng.uniform(-1, 1, (n_samples, 2)).astype(np.float32)
+    # Both channels are silent, and so identical, for the whole intro
+    stereo[:intro] = 0.0
+    mono = np.repeat(stereo[:, :1], 2, axis=1)
+
+    assert not PipelineProcessor._is_mono(stereo)
+    assert PipelineProcessor._is_mono(mono)
+    assert not PipelineProcessor._is_mono(np.zeros((n_samples, 2)))
+    assert not PipelineProcessor._is_mono(np.zeros((0, 2)))
+
+    # A stereo section late in the track is enough to keep both channels
+    mono[-intro:] = stereo[-intro:]
+    assert not PipelineProcessor._is_mono(mono)
 
 
 def test_pipeline_processor_missing_source(
-    dummy_target, dummy_splitter, missing_source_pipeline
+    dummy_sources, dummy_sample_rate, missing_source_pipeline
 ):
-    with mock.patch.object(sf, "read", new=mock_soundfile_read):
-        with mock.patch.object(sf, "write", new=mock_soundfile_write):
-            processor = PipelineProcessor(dummy_target, dummy_splitter)
-            processor._merge = mock.MagicMock()
-            with pytest.raises(NoPipelineSourceError):
-                processor.process([missing_source_pipeline], "test")
+    processor = PipelineProcessor(dummy_sources, dummy_sample_rate)
+    processor._merge = mock.create_autospec(processor._merge)
+    with pytest.raises(NoPipelineSourceError, match="missing"):
+        processor.process([missing_source_pipeline], "test")
+
+
+def test_pipeline_processor_get_stages():
+    def pipeline(source, sink):
+        return Pipeline(source=source, actions=[], sink=sink, save=False)
+
+    read_voice = pipeline("voice", "a")
+    read_a = pipeline("a", "b")
+    write_voice = pipeline("b", "voice")
+    independent = pipeline("voice", "c")
+
+    stages = PipelineProcessor._get_stages(
+        [read_voice, read_a, write_voice, independent]
+    )
+    assert stages == [[0], [1], [2], [3]]
+
+    stages = PipelineProcessor._get_stages([read_voice, independent, read_a])
+    assert stages == [[0, 1], [2]]
+
+    stages = PipelineProcessor._get_stages(
+        [read_voice, independent, read_a], dependencies={1: 0}
+    )
+    assert stages == [[0], [1, 2]]
+
+
+def test_pipeline_processor_get_prefixes():
+    def pipeline(source, actions, sink):
+        return Pipeline(source=source, actions=actions, sink=sink, save=False)
+
+    flat = Brownifier.flat
+    pipelines = [
+        pipeline("voice", [flat], "a"),
+        pipeline("voice", [flat, Brownifier.late], "b"),
+        pipeline("voice", [flat, Brownifier.sharp], "c"),
+        pipeline("voice", [Brownifier.early], "d"),
+        pipeline("voice", [Brownifier.early, Brownifier.late], "e"),
+        pipeline("voice", [flat], "f"),
+        pipeline("c", [], "voice"),
+        pipeline("voice", [flat], "g"),
+    ]
+    reuses, offers = PipelineProcessor._get_prefixes(pipelines)
+
+    # Pipelines which would shift the pitch again, or whose prefix has no
+    # pitch shift to share, start from their source. The last pipeline reads
+    # a different version of its source, so it cannot reuse anything from
+    # the earlier pipelines.
+    key = ("voice", -1, (flat,))
+    assert reuses == {1: (0, key), 5: (0, key)}
+    assert offers == {0: key}
+
+
+def test_pipeline_processor_pending_prefix_not_reused():
+    pipelines = [
+        Pipeline(
+            source="voice",
+            actions=[Brownifier.sharp, Brownifier.flat],
+            sink="a",
+            save=True,
+        ),
+        Pipeline(
+            source="voice", actions=[Brownifier.sharp], sink="b", save=True
+        ),
+    ]
+    reuses, offers = PipelineProcessor._get_prefixes(pipelines)
+    assert reuses == {}
+    assert offers == {}
+    assert PipelineProcessor._get_stages(pipelines) == [[0, 1]]
+
+
+def test_pipeline_processor_reuses_prefixes(dummy_sources, dummy_sample_rate):
+    flat = mock.MagicMock(side_effect=Brownifier.flat)
+    pipelines = [
+        Pipeline(source="voice", actions=[flat], sink="a", save=True),
+        Pipeline(
+            source="voice",
+            actions=[flat, Brownifier.late],
+            sink="b",
+            save=True,
+        ),
+    ]
+    processor = PipelineProcessor(dummy_sources, dummy_sample_rate)
+    processor._merge = mock.create_autospec(processor._merge)
+    with mock.patch.object(
+        actions, "_pitch_shift", wraps=actions._pitch_shift
+    ) as mock_pitch_shift:
+        processor.process(pipelines, "test")
+
+    assert flat.call_count == 1
+    assert mock_pitch_shift.call_count == 1
+    assert not processor._prefixes
+    assert np.array_equal(
+        processor.tracks["b"].audio,
+        np.roll(processor.tracks["a"].audio, round(0.035 * dummy_sample_rate)),
+    )
+
+
+def test_pipeline_processor_fuses_after_shared_prefix(
+    dummy_sources, dummy_sample_rate
+):
+    pipelines = [
+        Pipeline(
+            source="voice",
+            actions=[Brownifier.sharp],
+            sink="a",
+            save=True,
+        ),
+        Pipeline(
+            source="voice",
+            actions=[Brownifier.sharp, Brownifier.flat],
+            sink="b",
+            save=True,
+        ),
+    ]
+    original_audio = np.copy(dummy_sources["voice"])
+    processor = PipelineProcessor(dummy_sources, dummy_sample_rate)
+    processor._merge = mock.create_autospec(processor._merge)
+    processor.process(pipelines, "test")
+
+    # Sharing the first pipeline must not stop the second from cancelling
+    # out its own pitch changes
+    assert np.array_equal(processor.tracks["b"].audio, original_audio)
+
+
+def test_pipeline_processor_get_exclusive():
+    def pipeline(source, sink):
+        return Pipeline(source=source, actions=[], sink=sink, save=False)
+
+    pipelines = [
+        pipeline("voice", "voice"),
+        pipeline("voice", "a"),
+        pipeline("voice", "voice"),
+        pipeline("bass", "bass"),
+        pipeline("drums", "b"),
+    ]
+
+    # The third pipeline shares the version of voice written by the first
+    # with the second, and the last pipeline keeps drums around
+    assert PipelineProcessor._get_exclusive(pipelines) == {0, 3}
+
+
+def test_pipeline_processor_skips_exclusive_clone(
+    dummy_sources, dummy_sample_rate
+):
+    pipelines = [
+        Pipeline(
+            source="voice",
+            actions=[Brownifier.early],
+            sink="voice",
+            save=False,
+        ),
+        Pipeline(source="voice", actions=[], sink="out", save=True),
+    ]
+    original_audio = np.copy(dummy_sources["voice"])
+    processor = PipelineProcessor(dummy_sources, dummy_sample_rate)
+    processor._merge = mock.create_autospec(processor._merge)
+    with mock.patch.object(
+        Track, "clone", autospec=True, side_effect=Track.clone
+    ) as mock_clone:
+        processor.process(pipelines, "test")
+    assert mock_clone.call_count == 1
+    assert np.array_equal(
+        processor.tracks["out"].audio,
+        np.roll(original_audio, round(-0.035 * dummy_sample_rate)),
+    )
+
+
+def test_pipeline_processor_max_workers(dummy_sources, dummy_sample_rate):
+    pipelines = [
+        Pipeline(source="voice", actions=[action], sink=sink, save=True)
+        for action, sink in [
+            (Brownifier.flat, "a"),
+            (Brownifier.sharp, "b"),
+            (Brownifier.early, "c"),
+        ]
+    ]
+    processor = PipelineProcessor(
+        dummy_sources, dummy_sample_rate, max_workers=8
+    )
+    processor._merge = mock.create_autospec(processor._merge)
+    with mock.patch(
+        "brownify.runners.ThreadPoolExecutor", wraps=ThreadPoolExecutor
+    ) as mock_executor, mock.patch(
+        "brownify.runners.os.cpu_count", return_value=8
+    ), mock.patch.object(
+        Brownifier, "materialize", wraps=Brownifier.materialize
+    ) as mock_materialize:
+        processor.process(pipelines, "test")
+
+    mock_executor.assert_called_once_with(max_workers=3)
+    # The three pipelines run together, so each FFT gets a share of the CPUs
+    assert mock_materialize.call_count == 3
+    assert all(call.args[2] == 2 for call in mock_materialize.call_args_list)
+    assert all(sink in processor.tracks for sink in ["a", "b", "c"])
+
+
+@pytest.mark.parametrize("max_workers", [0, -1])
+def test_pipeline_processor_invalid_max_workers(
+    dummy_sources, dummy_sample_rate, max_workers
+):
+    with pytest.raises(InvalidInputError, match="At least one worker"):
+        PipelineProcessor(
+            dummy_sources, dummy_sample_rate, max_workers=max_workers
+        )
 
 
 def test_audio_merger_merge_no_inputs():
-    with pytest.raises(InvalidInputError):
+    with pytest.raises(InvalidInputError, match="No tracks were provided"):
         AudioMerger.merge([])
 
 
-def test_audio_merger_merge_failure(dummy_files):
-    with mock.patch.object(
-        AudioSegment, "from_wav", new=mock_audio_segment_from_wav_fail
-    ):
-        with pytest.raises(MergingError):
-            AudioMerger.merge(dummy_files)
+def test_audio_merger_merge(dummy_tracks):
+    merged = AudioMerger.merge(dummy_tracks)
+    pcm = np.array(merged.get_array_of_samples()).reshape(-1, 2)
+
+    # Mono tracks are mixed into both channels, the mix is scaled down by its
+    # peak, and the output is as long as the longest track
+    max_value = np.iinfo(np.int16).max
+    expected = np.array([[1.25, 0.25], [0.5, 0.25], [-0.5, -0.5]]) / 1.25
+    assert merged.channels == 2
+    assert merged.frame_rate == 12345
+    assert np.array_equal(pcm, (expected * max_value).astype(np.int16))
+
+
+def test_audio_merger_merge_failure(mismatched_tracks):
+    with pytest.raises(MergingError, match="different sample rates"):
+        AudioMerger.merge(mismatched_tracks)
 
 
 def test_audio_merger_save_file_failure(
     dummy_filename, dummy_failing_audio_segment
 ):
-    with pytest.raises(MergingError):
-        AudioMerger.save_file(dummy_filename, dummy_failing_audio_segment)
+    with mock.patch("brownify.runners._lameenc", None):
+        with pytest.raises(MergingError, match="Unable to save"):
+            AudioMerger.save_file(dummy_filename, dummy_failing_audio_segment)
+
+
+def test_audio_merger_save_file_lameenc(dummy_tracks, tmp_path):
+    filename = tmp_path / "merged.mp3"
+    audio = AudioMerger.merge(dummy_tracks)
+    mock_lameenc = mock.MagicMock()
+    encoder = mock_lameenc.Encoder.return_value
+    encoder.encode.return_value = b"frames"
+    encoder.flush.return_value = b"tail"
+    with mock.patch("brownify.runners._lameenc", mock_lameenc):
+        AudioMerger.save_file(str(filename), audio)
+
+    encoder.set_in_sample_rate.assert_called_once_with(12345)
+    encoder.set_channels.assert_called_once_with(2)
+    encoder.encode.assert_called_once_with(audio.raw_data)
+    assert filename.read_bytes() == b"framestail"
+
+
+def test_audio_merger_save_file_lameenc_failure(dummy_tracks, tmp_path):
+    audio = AudioMerger.merge(dummy_tracks)
+    mock_lameenc = mock.MagicMock()
+    mock_lameenc.Encoder.return_value.encode.side_effect = RuntimeError
+    with mock.patch("brownify.runners._lameenc", mock_lameenc):
+        with pytest.raises(MergingError, match="Unable to save"):
+            AudioMerger.save_file(str(tmp_path / "merged.mp3"), audio)
@@ -1,10 +1,13 @@
 from unittest import mock
 
+import numpy as np
 import pytest
 from spleeter import SpleeterError
+from spleeter.separator import Separator
 
 from brownify.errors import InvalidInputError, SplittingError
 from brownify.splitters import (
+    AudioSplitter,
     AudioSplitter2Channel,
     AudioSplitter4Channel,
     AudioSplitter5Channel,
@@ -18,72 +21,145 @@ def dummy_filename():
     return "dummy"
 
 
-class MockSeparator:
-    pass
+@pytest.fixture
+def mock_separator():
+    # Autospeccing the separator makes the tests fail if they call it in a
+    # way that the real Separator does not support
+    return mock.create_autospec(Separator, instance=True, spec_set=True)
 
 
 def mock_init_separator(self):
     pass
 
 
-def test_audio_splitter_factory_2_channel():
-    with mock.patch.object(
-        AudioSplitter2Channel, "_init_separator", new=mock_init_separator
-    ):
-        splitter = AudioSplitterFactory.get_audio_splitter(
-            AudioSplitterType.ONLY_VOCALS
-        )
-        assert isinstance(splitter, AudioSplitter2Channel)
-        assert len(splitter.get_channels()) == 2
+@pytest.fixture(autouse=True)
+def patch_init_separator(monkeypatch):
+    # Every splitter gets its separator through AudioSplitter, so patching
+    # it once keeps all of the tests from loading a Spleeter model
+    monkeypatch.setattr(AudioSplitter, "_init_separator", mock_init_separator)
 
 
-def test_audio_splitter_factory_4_channel():
-    with mock.patch.object(
-        AudioSplitter4Channel, "_init_separator", new=mock_init_separator
-    ):
-        splitter = AudioSplitterFactory.get_audio_splitter(
-            AudioSplitterType.FOUR_STEM
-        )
-        assert isinstance(splitter, AudioSplitter4Channel)
-        assert len(splitter.get_channels()) == 4
+@pytest.mark.parametrize(
+    "splitter_type, splitter_cls, num_channels",
+    [
+        (AudioSplitterType.ONLY_VOCALS, AudioSplitter2Channel, 2),
+        (AudioSplitterType.FOUR_STEM, AudioSplitter4Channel, 4),
+        (AudioSplitterType.FIVE_STEM, AudioSplitter5Channel, 5),
+    ],
+)
+def test_audio_splitter_factory(splitter_type, splitter_cls, num_channels):
+    splitter = AudioSplitterFactory.get_audio_splitter(splitter_type)
+    assert isinstance(splitter, splitter_cls)
+    assert len(splitter.get_channels()) == num_channels
 
 
-def test_audio_splitter_factory_5_channel():
-    with mock.patch.object(
-        AudioSplitter5Channel, "_init_separator", new=mock_init_separator
-    ):
-        splitter = AudioSplitterFactory.get_audio_splitter(
-            AudioSplitterType.FIVE_STEM
-        )
-        assert isinstance(splitter, AudioSplitter5Channel)
-        assert len(splitter.get_channels()) == 5
-
-
-# This is not useful yet, but we can improve this test and spin up similar
-# tests if we have more complex exception handling in the implementation.
-def test_audio_splitter_split_success(dummy_filename):
-    with mock.patch.object(
-        AudioSplitter2Channel, "_init_separator", new=mock_init_separator
-    ):
-        splitter = AudioSplitter2Channel()
-        splitter.separator = MockSeparator()
-        splitter.separator.separate_to_file = mock.MagicMock()
-        splitter.split(dummy_filename)
+@pytest.fixture
+def dummy_waveform():
+    return np.zeros((16, 2), dtype=np.float32)
+
+
+def test_audio_splitter_split_success(dummy_waveform, mock_separator):
+    splitter = AudioSplitter2Channel()
+    splitter.separator = mock_separator
+    # These are the keys that the Spleeter 2stems model returns
+    mock_separator.separate.return_value = {
+        "accompaniment": dummy_waveform,
+        "vocals": dummy_waveform,
+    }
+    sources = splitter.split(dummy_waveform)
+
+    assert sorted(sources) == splitter.get_channels()
+
+
+def test_audio_splitter_split_failure(dummy_waveform, mock_separator):
+    splitter = AudioSplitter2Channel()
+    splitter.separator = mock_separator
+    mock_separator.separate.side_effect = SpleeterError("Could not split")
+    with pytest.raises(SplittingError):
+        splitter.split(dummy_waveform)
+
+
+def test_audio_splitter_split_all(dummy_waveform, mock_separator):
+    splitter = AudioSplitter2Channel()
+    splitter.separator = mock_separator
+    mock_separator.separate.return_value = {}
+    sources = splitter.split_all([dummy_waveform, dummy_waveform])
+
+    assert splitter.separator.separate.call_count == 2
+    assert len(sources) == 2
 
 
-def test_audio_splitter_split_failure(dummy_filename):
-    with mock.patch.object(
-        AudioSplitter2Channel, "_init_separator", new=mock_init_separator
+def test_audio_splitter_load_failure(dummy_filename):
+    with mock.patch(
+        "brownify.splitters.AudioAdapter.default",
+        side_effect=SpleeterError("ffmpeg binary not found"),
     ):
-        splitter = AudioSplitter2Channel()
-        splitter.separator = MockSeparator()
-        splitter.separator.separate_to_file = mock.MagicMock(
-            side_effect=SpleeterError("Could not split")
-        )
         with pytest.raises(SplittingError):
-            splitter.split(dummy_filename)
+            AudioSplitter.load(dummy_filename)
+
+
+@pytest.mark.parametrize(
+    "channels, splitter_type",
+    [
+        ({"vocals"}, AudioSplitterType.ONLY_VOCALS),
+        ({"accompaniment", "vocals"}, AudioSplitterType.ONLY_VOCALS),
+        ({"bass", "vocals"}, AudioSplitterType.FOUR_STEM),
+        ({"bass", "drums", "vocals"}, AudioSplitterType.FOUR_STEM),
+        ({"other", "vocals"}, AudioSplitterType.FIVE_STEM),
+        ({"drums", "piano"}, AudioSplitterType.FIVE_STEM),
+    ],
+)
+def test_audio_splitter_factory_type(channels, splitter_type):
+    assert (
+        AudioSplitterFactory.get_audio_splitter_type(channels) == splitter_type
+    )
+
+
+def test_audio_splitter_not_concrete():
+    with pytest.raises(TypeError, match="cannot be used directly"):
+        AudioSplitter()
+    with pytest.raises(TypeError, match="cannot be used directly"):
+        AudioSplitter.warmup()
+
+
+def test_audio_splitter_subclass_requires_model():
+    with pytest.raises(TypeError, match="must declare MODEL and CHANNELS"):
+
+        class AudioSplitterNoModel(AudioSplitter):
+            pass
 
 
 def test_audio_splitter_factory_failure():
     with pytest.raises(InvalidInputError):
         AudioSplitterFactory.get_audio_splitter("invalid")
+
+
+def test_audio_splitter_separator_cached():
+    with mock.patch("brownify.splitters.Separator") as mock_separator_cls:
+        with mock.patch.dict(AudioSplitter._separator_cache, clear=True):
+            first = AudioSplitter._get_separator("spleeter:2stems")
+            second = AudioSplitter._get_separator("spleeter:2stems")
+            other = AudioSplitter._get_separator("spleeter:4stems")
+
+    assert first is second
+    assert mock_separator_cls.call_count == 2
+    assert other is mock_separator_cls.return_value
+
+
+def test_audio_splitter_warmup():
+    with mock.patch(
+        "brownify.splitters.ModelProvider.default"
+    ) as mock_default:
+        AudioSplitter2Channel.warmup()
+
+    # Only the model files are fetched, without running the model
+    mock_default.return_value.get.assert_called_once_with("2stems")
+
+
+def test_audio_splitter_warmup_failure():
+    with mock.patch(
+        "brownify.splitters.ModelProvider.default",
+        side_effect=OSError("Could not download"),
+    ):
+        with pytest.raises(SplittingError):
+            AudioSplitter2Channel.warmup()